@@ -14,13 +14,14 @@ from PIL import Image
 
 from edit3d import device
 from edit3d.models import deep_sdf
+from edit3d.toolbox.turntable import write_turntable
 from edit3d.utils.utils import dict2namespace
 
 logger = logging.getLogger(__name__)
 
 
-def save(trainer, latent, target, outdir, imname, save_ply=False):
-    """Save 2D and 3D modalities after editing"""
+def save(trainer, latent, target, outdir, imname, save_ply=False, turntable_views=0, pred_3d=None):
+    """Save 2D and 3D modalities after editing, pred_3d: the shape already rendered, if any"""
     colormesh_filename = os.path.join(outdir, imname)
     latent_filename = os.path.join(outdir, imname + ".pth")
     pred_sketch_filename = os.path.join(outdir, imname + "_sketch.png")
@@ -39,47 +40,70 @@ def save(trainer, latent, target, outdir, imname, save_ply=False):
                 N=256,
                 max_batch=int(2 ** 18),
             )
-    pred_3d = trainer.render_express(shape_code, color_code, resolution=256)
+    if pred_3d is None:
+        pred_3d = trainer.render_express(shape_code, color_code, resolution=256)
     pred_3d = cv2.cvtColor(pred_3d, cv2.COLOR_RGB2BGR)
     cv2.imwrite(pred_3D_filename, pred_3d)
+    if turntable_views > 0:
+        frames = trainer.render_turntable(shape_code, color_code, num_views=turntable_views, resolution=256)
+        write_turntable(frames, os.path.join(outdir, imname + "_turntable.gif"))
     pred_sketch = trainer.render_sketch(shape_code)
     save_image(pred_sketch, pred_sketch_filename)
     save_image(target.squeeze().cpu().numpy(), target_filename)
 
 
-def save_init(trainer, latent, outdir, imname, colormesh=True):
-    """Save 2D and 3D modalities before editing"""
+def cached_render(trainer, cache, shape_code, color_code=None, resolution=512):
+    """trainer.render_express, looked up in cache by models, latents, resolution and render settings if given"""
+    if cache is None:
+        return trainer.render_express(shape_code, color_code, resolution=resolution)
+    render_cfg = sorted((k, v) for k, v in vars(trainer.cfg.render_web).items() if k != "resolution")
+    digest = deep_sdf.cache.model_digest(trainer.deepsdf_net, trainer.colorsdf_net)
+    key = cache.key("render", digest, shape_code, color_code, resolution, render_cfg)
+    return cache.array(key, lambda: trainer.render_express(shape_code, color_code, resolution=resolution))
+
+
+def save_init(trainer, latent, outdir, imname, colormesh=True, cache=None):
+    """Save 2D and 3D modalities before editing, reusing the meshes and renders in cache if given"""
     colormesh_filename = os.path.join(outdir, imname)
     mesh_filename = os.path.join(outdir, imname + "_wocolor")
     latent_filename = os.path.join(outdir, imname + ".pth")
     pred_3D_filename = os.path.join(outdir, imname + "_3D.png")
     pred_wocolor_3D_filename = os.path.join(outdir, imname + "_wocolor_3D.png")
     shape_code, color_code = latent
-    if colormesh:  # generate mesh with surface color from 3D colornet
-        with torch.no_grad():
-            deep_sdf.colormesh.create_mesh(
-                trainer.deepsdf_net,
-                trainer.colorsdf_net,
-                shape_code.to(device),
-                color_code.to(device),
-                colormesh_filename,
-                N=256,
-                max_batch=int(2 ** 18),
-            )
-    else:  # generate mesh with default color
+
+    def make_mesh(_):
         with torch.no_grad():
-            deep_sdf.mesh.create_mesh(
-                trainer.deepsdf_net,
-                shape_code.to(device),
-                mesh_filename,
-                N=256,
-                max_batch=int(2 ** 18),
-            )
+            if colormesh:  # generate mesh with surface color from 3D colornet
+                deep_sdf.colormesh.create_mesh(
+                    trainer.deepsdf_net,
+                    trainer.colorsdf_net,
+                    shape_code.to(device),
+                    color_code.to(device),
+                    colormesh_filename,
+                    N=256,
+                    max_batch=int(2 ** 18),
+                )
+            else:  # generate mesh with default color
+                deep_sdf.mesh.create_mesh(
+                    trainer.deepsdf_net,
+                    shape_code.to(device),
+                    mesh_filename,
+                    N=256,
+                    max_batch=int(2 ** 18),
+                )
+
+    filename = (colormesh_filename if colormesh else mesh_filename) + ".ply"
+    if cache is None:
+        make_mesh(filename)
+    else:
+        digest = deep_sdf.cache.model_digest(trainer.deepsdf_net, trainer.colorsdf_net)
+        key = cache.key("mesh", digest, shape_code, color_code if colormesh else None, 256)
+        cache.fetch(key, ".ply", filename, make_mesh)
     torch.save(latent, latent_filename)
-    pred_3d_nocolor = trainer.render_express(shape_code, resolution=512)
+    pred_3d_nocolor = cached_render(trainer, cache, shape_code, resolution=512)
     pred_3d_nocolor = cv2.cvtColor(pred_3d_nocolor, cv2.COLOR_RGB2BGR)
     cv2.imwrite(pred_wocolor_3D_filename, pred_3d_nocolor)
-    pred_3d = trainer.render_express(shape_code, color_code, resolution=512)
+    pred_3d = cached_render(trainer, cache, shape_code, color_code, resolution=512)
     pred_3d = cv2.cvtColor(pred_3d, cv2.COLOR_RGB2BGR)
     cv2.imwrite(pred_3D_filename, pred_3d)
     pred_sketch = trainer.render_sketch(shape_code)
@@ -164,6 +188,7 @@ def main(args, cfg):
     source_dir = os.path.abspath(args.source_dir)
 
     os.makedirs(args.outdir, exist_ok=True)
+    cache = deep_sdf.cache.ArtifactCache(args.cache_dir, max_bytes=args.cache_mb * 2 ** 20) if args.cache_dir else None
 
     if "plane" in args.category:
         prefix = "sketch-T-2"
@@ -190,7 +215,7 @@ def main(args, cfg):
             source_latent = trainer.get_known_latent(trainer.sid2idx[shapeid])
             initdir = os.path.join(targetdir, "init")
             os.makedirs(initdir, exist_ok=True)
-            save_init(trainer, source_latent, initdir, shapeid + "_init")
+            save_init(trainer, source_latent, initdir, shapeid + "_init", cache=cache)
 
             # editing
             edit_latent, color_code = edit(
@@ -202,7 +227,10 @@ def main(args, cfg):
                 args.gamma,
                 args.beta,
             )
-            for iteration, latent_snap in enumerate(edit_latent[:10]):
+            # consecutive snapshots differ slightly, render them as a warm started sequence
+            snapshots = edit_latent[:10]
+            pred_3ds = trainer.render_express_sequence(snapshots, color_code, resolution=256)
+            for iteration, latent_snap in enumerate(snapshots):
                 save(
                     trainer,
                     (latent_snap, color_code),
@@ -210,6 +238,8 @@ def main(args, cfg):
                     targetdir,
                     imname + f"_{iteration}",
                     save_ply=False,
+                    turntable_views=args.turntable,
+                    pred_3d=pred_3ds[iteration],
                 )
 
 
@@ -225,6 +255,9 @@ if __name__ == "__main__":
     parser.add_argument("--beta", default=0.5, type=float)
     parser.add_argument("--gamma", default=0.02, type=float)
     parser.add_argument("--epoch", default=10, type=int)
+    parser.add_argument("--turntable", default=0, type=int, help="views of a turntable gif per edit, 0 to skip")
+    parser.add_argument("--cache_dir", default=None, type=str, help="store of meshes and renders of repeated latents")
+    parser.add_argument("--cache_mb", default=4096, type=int, help="size of the cache store before eviction")
     args = parser.parse_args()
 
     with open(args.config, "r") as f:
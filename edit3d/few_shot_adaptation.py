@@ -18,8 +18,9 @@ from edit3d.utils.utils import dict2namespace
 logger = logging.getLogger(__name__)
 
 
-def render_all(trainer, feat_shape, feat_color):
-    shape_img = trainer.render_express(feat_shape, feat_color)
+def render_all(trainer, feat_shape, feat_color, shape_img=None):
+    if shape_img is None:
+        shape_img = trainer.render_express(feat_shape, feat_color)
     sketch_img = trainer.render_sketch(feat_shape)
     sketch_img = np.uint8(cv2.resize(sketch_img, shape_img.shape[:2]) * 255)
     color_img = trainer.render_color2d(feat_color, feat_shape)
@@ -28,9 +29,11 @@ def render_all(trainer, feat_shape, feat_color):
 
 
 def render_batch(trainer, feat_shape, feat_color, path):
+    num_imgs = min(16, feat_shape.size(0))
+    shape_imgs = trainer.render_express_batch(feat_shape[:num_imgs], feat_color[:num_imgs])
     out = []
-    for i in range(min(16, feat_shape.size(0))):
-        rgb, shape, sketch = render_all(trainer, feat_shape[i : i + 1], feat_color[i : i + 1])
+    for i in range(num_imgs):
+        rgb, shape, sketch = render_all(trainer, feat_shape[i : i + 1], feat_color[i : i + 1], shape_imgs[i])
         out.append(cv2.hconcat([rgb, shape, sketch]))
     out = cv2.vconcat(out)
     cv2.imwrite(path, out)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def scan_dir(path, stat=False):
+    """
+    The entries of path as {name: [is_file, size, mtime_ns]}
+
+    size and mtime_ns are only read with stat, and are None for dirs.
+    """
+    entries = {}
+    with os.scandir(path) as dir_entries:
+        for entry in dir_entries:
+            is_file = entry.is_file()
+            if stat and is_file:
+                file_stat = entry.stat()
+                entries[entry.name] = [True, file_stat.st_size, file_stat.st_mtime_ns]
+            else:
+                entries[entry.name] = [is_file, None, None]
+    return entries
+
+
+class DataManifest:
+    """
+    Scans of the sdf_data_dir dirs of get_data_lists, kept in manifest_dir/manifest_<sha1 of the dirs>.json
+
+    A dir is scanned again only when its mtime changes, i.e. when entries are added, removed or renamed in it. Files
+    rewritten in place do not change the mtime of their dir, see rebuild and edit3d.toolbox.build_manifest.
+    """
+
+    # a dir modified this recently may change again within the same mtime tick, so its scan is not trusted
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, manifest_dir, dirs):
+        self.dirs = {kind: os.path.abspath(path) for kind, path in dirs.items()}
+        key = hashlib.sha1(json.dumps(sorted(self.dirs.items())).encode("utf-8")).hexdigest()[:16]
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.path = os.path.join(manifest_dir, "manifest_%s.json" % key)
+        try:
+            with open(self.path) as f:
+                self.scans = json.load(f)["dirs"]
+        except (OSError, ValueError, KeyError):
+            self.scans = {}
+
+    def entries(self, rebuild=False):
+        """{kind: {name: [is_file, size, mtime_ns]}} of the dirs, scanning only those that changed, or all on rebuild"""
+        changed = False
+        for kind, path in self.dirs.items():
+            mtime_ns = os.stat(path).st_mtime_ns
+            scan = self.scans.get(kind)
+            if rebuild or scan is None or scan["path"] != path or scan["mtime_ns"] != mtime_ns:
+                logger.info("[DataManifest] Scanning %s", path)
+                if time.time_ns() - mtime_ns < self.RACY_NS:
+                    mtime_ns = None
+                self.scans[kind] = {"path": path, "mtime_ns": mtime_ns, "entries": scan_dir(path, stat=True)}
+                changed = True
+        if changed:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dirs": self.scans}, f)
+            os.replace(tmp_path, self.path)
+        return {kind: self.scans[kind]["entries"] for kind in self.dirs}
+
+    def rebuild(self):
+        """Scan all dirs again"""
+        return self.entries(rebuild=True)
+
+    def changed_files(self):
+        """Files of the manifest whose size or mtime changed since their dir was scanned, or that are gone"""
+        changed = []
+        for kind, scan in self.scans.items():
+            for name, (is_file, size, mtime_ns) in scan["entries"].items():
+                if not is_file:
+                    continue
+                path = os.path.join(scan["path"], name)
+                try:
+                    file_stat = os.stat(path)
+                except FileNotFoundError:
+                    changed.append(path)
+                    continue
+                if file_stat.st_size != size or file_stat.st_mtime_ns != mtime_ns:
+                    changed.append(path)
+        return changed
@@ -0,0 +1,124 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms as transforms
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def load_images(sketch_file, color2d_file, imsize):
+    """
+    Decode and resize a sketch and a color image as NPYLoaderN does, stored exactly as uint8
+
+    :return: (1,imsize,imsize) uint8 sketch of 0/1, (3,imsize,imsize) uint8 color, i.e. transforms.ToTensor() * 255
+    """
+    transform = transforms.Compose(
+        [
+            transforms.Resize((imsize, imsize)),
+            transforms.ToTensor(),
+        ]
+    )
+    sketch = transform(Image.open(sketch_file)).mean(dim=0).round().unsqueeze(0)  # C is binary black or white.
+    color = transform(Image.open(color2d_file))[0:3]  # no alpha channel
+    if color.shape[0] != 3:
+        raise ValueError("Color image %s is not RGB" % color2d_file)
+    return sketch.numpy().astype(np.uint8), color.mul(255).round().numpy().astype(np.uint8)
+
+
+def images_to_tensors(sketch, color, out=None):
+    """The float tensors of NPYLoaderN from the uint8 arrays of load_images, or written to the tensors out"""
+    if out is None:
+        return torch.from_numpy(np.array(sketch)).float(), torch.from_numpy(np.array(color)).float().div(255)
+    out[0].copy_(torch.from_numpy(np.asarray(sketch)))
+    out[1].copy_(torch.from_numpy(np.asarray(color))).div_(255)
+    return out
+
+
+def _load_images(args):
+    return load_images(*args)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ImageCache:
+    """
+    Sketch and color images of the (shape_id, surface, sphere, sketch, color2d) filelist of NPYLoaderN, decoded and
+    resized once into [num_shapes, C, imsize, imsize] uint8 memory-mapped .npy files in cache_dir
+
+    The images of a shape are decoded again, on num_workers processes, only when the mtime or size of its files change.
+    """
+
+    def __init__(self, cache_dir, filelist, imsize, num_workers=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        files = [(x[3], x[4]) for x in filelist]
+        key = hashlib.sha1(repr((imsize, files)).encode("utf-8")).hexdigest()[:16]
+        prefix = os.path.join(cache_dir, "images_%d_%s" % (imsize, key))
+        self.sketch_path = prefix + "_sketch.npy"
+        self.color_path = prefix + "_color.npy"
+        stamps_path = prefix + "_stamps.npy"
+        self.sketches = None
+        self.colors = None
+
+        stamps = np.array([[_stamp(f) for f in pair] for pair in files], dtype=np.int64).reshape(len(files), 2, 2)
+        shapes = {self.sketch_path: (len(files), 1, imsize, imsize), self.color_path: (len(files), 3, imsize, imsize)}
+        try:
+            cached_stamps = np.load(stamps_path)
+            arrays = {path: np.load(path, mmap_mode="r+") for path in shapes}
+            if cached_stamps.shape != stamps.shape or any(arrays[path].shape != shapes[path] for path in shapes):
+                raise ValueError("stale image cache %s" % prefix)
+            stale = np.flatnonzero((cached_stamps != stamps).any(axis=(1, 2)))
+        except (OSError, ValueError):
+            arrays = {
+                path: np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+                for path, shape in shapes.items()
+            }
+            stale = np.arange(len(files))
+
+        if len(stale) > 0:
+            logger.info("[ImageCache] Decoding %d / %d shapes to %s", len(stale), len(files), prefix)
+            jobs = [(files[i][0], files[i][1], imsize) for i in stale]
+            if num_workers == 1:
+                images = map(_load_images, jobs)
+            else:
+                pool = ProcessPoolExecutor(max_workers=num_workers)
+                images = pool.map(_load_images, jobs, chunksize=16)
+            try:
+                for i, (sketch, color) in zip(stale, images):
+                    arrays[self.sketch_path][i] = sketch
+                    arrays[self.color_path][i] = color
+            finally:
+                if num_workers != 1:
+                    pool.shutdown()
+            for array in arrays.values():
+                array.flush()
+            # the stamps are written last, so that an interrupted build is redone
+            np.save(stamps_path + ".tmp.npy", stamps)
+            os.replace(stamps_path + ".tmp.npy", stamps_path)
+        del arrays
+
+    def __getstate__(self):
+        # workers map the cache themselves
+        state = self.__dict__.copy()
+        state["sketches"] = None
+        state["colors"] = None
+        return state
+
+    def __getitem__(self, indices):
+        """(B,1,imsize,imsize) sketch and (B,3,imsize,imsize) color float tensors of the shapes indices"""
+        return self.read(indices)
+
+    def read(self, indices, out=None):
+        """The images of the shapes indices, written to the (sketch, color) tensors out if given"""
+        if self.sketches is None:
+            self.sketches = np.load(self.sketch_path, mmap_mode="r")
+            self.colors = np.load(self.color_path, mmap_mode="r")
+        return images_to_tensors(self.sketches[indices], self.colors[indices], out)
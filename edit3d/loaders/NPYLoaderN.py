@@ -1,8 +1,12 @@
 import numpy as np
+import torch
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms as transforms
 
+from edit3d.loaders.ImageCache import ImageCache
+from edit3d.utils.StagingRing import StagedBatch
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,7 +19,13 @@ class NPYLoaderN(Dataset):
             npoints_coarse=2048,
             only_sketch=False,
             imsize=64,
+            image_cache_dir=None,
+            image_cache_workers=None,
     ):
+        """
+        image_cache_dir keeps the decoded and resized images in memory-mapped files, see ImageCache.
+        staging, a StagingRing of staging_shapes, makes __getitems__ collate into its slots.
+        """
         self.filelist = filelist
         self.npoints_fine = npoints_fine
         self.npoints_coarse = npoints_coarse
@@ -26,6 +36,11 @@ class NPYLoaderN(Dataset):
             ]
         )
         self.only_sketch = only_sketch
+        self.imsize = imsize
+        self.staging = None
+        self.image_cache = None
+        if image_cache_dir is not None:
+            self.image_cache = ImageCache(image_cache_dir, filelist, imsize, num_workers=image_cache_workers)
         logger.info(
             "[NPYLoaderN] Number of shapes: {}; #fine: {}; #coarse: {}.".format(
                 len(filelist), npoints_fine, npoints_coarse
@@ -35,15 +50,14 @@ class NPYLoaderN(Dataset):
     def __len__(self):
         return len(self.filelist)
 
-    def __getitem__(self, idx):
-        shape_id, surface_file, sphere_file, sketch_file, color2d_file = self.filelist[idx]
-
+    def sample_points(self, surface, sphere):
+        """Subsample npoints_fine rows of xyzd + RGB from the surface (inside; outside) and sphere samples"""
         # for surface samples: [xyzd_inside; xyzd_outside] half inside, half outside
         num_inside_points = int(self.npoints_fine * 0.45)
         num_outside_points = num_inside_points
         num_sphere_points = self.npoints_fine - num_inside_points - num_outside_points
         # Surface samples
-        data = np.load(surface_file, mmap_mode="r")
+        data = surface
         num_samples = data.shape[0]
         data_sur = np.array([[]])
         if num_samples:
@@ -52,7 +66,7 @@ class NPYLoaderN(Dataset):
             subset_idx = np.concatenate([subset_idx_inside, subset_idx_outside])
             data_sur = data[subset_idx, :]  # xyzd + RGB
         # Sphere samples
-        data = np.load(sphere_file, mmap_mode="r")
+        data = sphere
         num_samples = data.shape[0]
         data_sph = np.array([[]])
         if num_samples:
@@ -60,16 +74,51 @@ class NPYLoaderN(Dataset):
             subset_idx = np.random.choice(num_samples, num_sphere_points, replace=True)
             data_sph = data[subset_idx, :]  # xyzd + RGB (-1, -1, -1)
         # combine
-        data_f = np.concatenate([data_sur, data_sph], axis=0)
+        return np.concatenate([data_sur, data_sph], axis=0)
+
+    def point_arrays(self, idx):
+        """Surface and sphere samples of shape idx, memory-mapped"""
+        _, surface_file, sphere_file, _, _ = self.filelist[idx]
+        return np.load(surface_file, mmap_mode="r"), np.load(sphere_file, mmap_mode="r")
+
+    def images(self, indices, out=None):
+        """(B,1,imsize,imsize) sketch and (B,3,imsize,imsize) color tensors of the shapes indices, or written to out"""
+        if self.image_cache is not None:
+            return self.image_cache.read(indices, out)
+        sketches, colors = [], []
+        for idx in indices:
+            _, _, _, sketch_file, color2d_file = self.filelist[idx]
+            # sketch samples
+            data_im = Image.open(sketch_file)
+            data_im = self.transform(data_im)  # N*C*H*W
+            sketches.append(data_im.mean(dim=0).round().unsqueeze(0))  # C is binary black or white.
+
+            # color image samples
+            data_color = Image.open(color2d_file)
+            colors.append(self.transform(data_color)[0:3])  # N*C*H*W  no alpha channel
+        if out is None:
+            return torch.stack(sketches), torch.stack(colors)
+        torch.stack(sketches, out=out[0])
+        torch.stack(colors, out=out[1])
+        return out
+
+    def staging_shapes(self, batch_size):
+        """The tensors of a batch of __getitems__, for StagingRing"""
+        surface, _ = self.point_arrays(0)
+        surface_dtype = torch.from_numpy(np.empty(0, surface.dtype)).dtype
+        return {
+            "surface_samples": ((batch_size, self.npoints_fine, surface.shape[1]), surface_dtype),
+            "sketch": ((batch_size, 1, self.imsize, self.imsize), torch.float32),
+            "color_2d": ((batch_size, 3, self.imsize, self.imsize), torch.float32),
+            "shape_indices": ((batch_size, 1), torch.int64),
+        }
+
+    def __getitem__(self, idx):
+        shape_id = self.filelist[idx][0]
 
-        # sketch samples
-        data_im = Image.open(sketch_file)
-        data_im = self.transform(data_im)  # N*C*H*W
-        data_im = data_im.mean(dim=0).round().unsqueeze(0)  # C is binary black or white.
+        data_f = self.sample_points(*self.point_arrays(idx))
 
-        # color image samples
-        data_color = Image.open(color2d_file)
-        data_color = self.transform(data_color)[0:3]  # N*C*H*W  no alpha channel
+        data_im, data_color = self.images([idx])
 
         idx_t = np.array([idx], dtype=np.longlong)
 
@@ -77,8 +126,60 @@ class NPYLoaderN(Dataset):
         return {
             "surface_samples": data_f,
             # "sphere_samples": np.array([]),
-            "sketch": data_im,
-            "color_2d": data_color,
+            "sketch": data_im[0],
+            "color_2d": data_color[0],
             "shape_indices": idx_t,
             "shape_ids": shape_id,
         }
+
+    def __getitems__(self, indices):
+        """
+        The batch of the shapes indices, already collated as np_collate_dict does
+
+        The points of the whole batch are drawn with one call to the RNG and gathered from the memory maps straight
+        into one (B,npoints_fine,C) array, the same distribution as sample_points. If indices have the slot of a
+        SlotBatchSampler and the dataset has staging, the batch is written into that slot and sent as a StagedBatch.
+        """
+        slot = getattr(indices, "slot", None) if self.staging is not None else None
+        num_inside_points = int(self.npoints_fine * 0.45)
+        num_surface_points = 2 * num_inside_points
+        arrays = [self.point_arrays(idx) for idx in indices]
+
+        # row = offset + floor(u * count): inside rows [0, n/2), outside rows [n/2, n) and sphere rows [0, m)
+        num_surface = np.array([surface.shape[0] // 2 for surface, _ in arrays])[:, None]
+        num_sphere = np.array([sphere.shape[0] for _, sphere in arrays])[:, None]
+        count = np.concatenate(
+            [
+                np.repeat(num_surface, num_surface_points, axis=1),
+                np.repeat(num_sphere, self.npoints_fine - num_surface_points, axis=1),
+            ],
+            axis=1,
+        )
+        rows = (np.random.random_sample(count.shape) * count).astype(np.int64)
+        rows[:, num_inside_points:num_surface_points] += num_surface
+
+        if slot is not None:
+            out_b = self.staging.slot(slot, len(indices))
+            surface_samples = out_b["surface_samples"].numpy()
+        else:
+            surface = arrays[0][0]
+            surface_samples = np.empty((len(indices), self.npoints_fine, surface.shape[1]), dtype=surface.dtype)
+        for b, (surface, sphere) in enumerate(arrays):
+            np.take(surface, rows[b, :num_surface_points], axis=0, out=surface_samples[b, :num_surface_points])
+            np.take(sphere, rows[b, num_surface_points:], axis=0, out=surface_samples[b, num_surface_points:])
+
+        shape_indices = np.array(indices, dtype=np.longlong)[:, None]
+        shape_ids = [self.filelist[idx][0] for idx in indices]
+        if slot is not None:
+            self.images(indices, out=(out_b["sketch"], out_b["color_2d"]))
+            out_b["shape_indices"].numpy()[:] = shape_indices
+            return StagedBatch(self.staging.id, slot, len(indices), {"shape_ids": shape_ids})
+
+        sketch, color_2d = self.images(indices)
+        return {
+            "surface_samples": torch.from_numpy(surface_samples),
+            "sketch": sketch,
+            "color_2d": color_2d,
+            "shape_indices": torch.from_numpy(shape_indices),
+            "shape_ids": shape_ids,
+        }
@@ -0,0 +1,151 @@
+import json
+import os
+
+import numpy as np
+
+import logging
+
+from edit3d.loaders.ImageCache import images_to_tensors, load_images
+from edit3d.loaders.NPYLoaderN import NPYLoaderN
+
+logger = logging.getLogger(__name__)
+
+# byte offsets into the shard files of the arrays of one shape
+INDEX_DTYPE = np.dtype(
+    [
+        ("shard", "<i4"),
+        ("surface", "<i8"),
+        ("surface_rows", "<i8"),
+        ("sphere", "<i8"),
+        ("sphere_rows", "<i8"),
+        ("sketch", "<i8"),
+        ("color_2d", "<i8"),
+    ]
+)
+ALIGNMENT = 64
+
+
+def pack_shards(filelist, outdir, imsize=64, shard_bytes=2 ** 30):
+    """
+    Pack the (shape_id, surface, sphere, sketch, color2d) files of NPYLoaderN into a few shard files for ShardLoaderN
+
+    The SDF samples are written as raw arrays, and the sketch and color images as the uint8 arrays of the decoded and
+    resized images, so that one memory map of each shard serves all its shapes. A shard is closed once it holds
+    shard_bytes. outdir gets shard_<i>.bin, index.npy with the byte offsets of every shape and meta.json.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    index = np.zeros(len(filelist), dtype=INDEX_DTYPE)
+    shards = []
+    dtype, columns = None, None
+    shard = None
+    try:
+        for i, (shape_id, surface_file, sphere_file, sketch_file, color2d_file) in enumerate(filelist):
+            surface = np.load(surface_file)
+            sphere = np.load(sphere_file)
+            if dtype is None:
+                dtype, columns = surface.dtype, surface.shape[1]
+            for data in (surface, sphere):
+                if data.size and (data.dtype != dtype or data.ndim != 2 or data.shape[1] != columns):
+                    raise ValueError(
+                        "%s: samples of %s %s, expected (n,%d) %s" % (shape_id, data.dtype, data.shape, columns, dtype)
+                    )
+            sketch, color = load_images(sketch_file, color2d_file, imsize)
+
+            if shard is None or shard.tell() >= shard_bytes:
+                if shard is not None:
+                    shard.close()
+                shards.append("shard_%03d.bin" % len(shards))
+                shard = open(os.path.join(outdir, shards[-1]), "wb")
+            index[i]["shard"] = len(shards) - 1
+            index[i]["surface_rows"] = len(surface) if surface.size else 0
+            index[i]["sphere_rows"] = len(sphere) if sphere.size else 0
+            for field, array in (
+                ("surface", surface.astype(dtype)),
+                ("sphere", sphere.astype(dtype)),
+                ("sketch", sketch),
+                ("color_2d", color),
+            ):
+                shard.write(b"\x00" * (-shard.tell() % ALIGNMENT))
+                index[i][field] = shard.tell()
+                shard.write(np.ascontiguousarray(array).tobytes())
+            if (i + 1) % 100 == 0:
+                logger.info("[pack_shards] %d / %d shapes", i + 1, len(filelist))
+    finally:
+        if shard is not None:
+            shard.close()
+
+    np.save(os.path.join(outdir, "index.npy"), index)
+    # written last, so that an interrupted pack is not loadable
+    meta = {
+        "shape_ids": [x[0] for x in filelist],
+        "shards": shards,
+        "dtype": np.dtype(dtype if dtype is not None else np.float32).str,
+        "columns": int(columns or 0),
+        "imsize": imsize,
+    }
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    logger.info("[pack_shards] %d shapes in %d shards to %s", len(filelist), len(shards), outdir)
+
+
+class ShardLoaderN(NPYLoaderN):
+    """NPYLoaderN over the shards written by pack_shards, read through one memory map per shard"""
+
+    def __init__(
+        self,
+        shard_dir,
+        npoints_fine=2048,
+        npoints_coarse=2048,
+        only_sketch=False,
+        imsize=64,
+        subset=None,
+    ):
+        with open(os.path.join(shard_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["imsize"] != imsize:
+            raise ValueError(
+                "%s is packed with imsize %d, not %d, see pack_shards" % (shard_dir, self.meta["imsize"], imsize)
+            )
+        self.shard_dir = shard_dir
+        self.index = np.load(os.path.join(shard_dir, "index.npy"))
+        self.shape_ids = self.meta["shape_ids"]
+        if subset:
+            self.index = self.index[:subset]
+            self.shape_ids = self.shape_ids[:subset]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.shards = None
+        super().__init__(
+            [(shape_id,) for shape_id in self.shape_ids], npoints_fine, npoints_coarse, only_sketch, imsize
+        )
+
+    def __getstate__(self):
+        # workers map the shards themselves
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def _array(self, entry, field, dtype, shape):
+        if self.shards is None:
+            self.shards = [
+                np.memmap(os.path.join(self.shard_dir, fn), dtype=np.uint8, mode="r") for fn in self.meta["shards"]
+            ]
+        start = int(entry[field])
+        count = int(np.prod(shape))
+        return self.shards[entry["shard"]][start : start + count * dtype.itemsize].view(dtype).reshape(shape)
+
+    def point_arrays(self, idx):
+        entry = self.index[idx]
+        columns = self.meta["columns"]
+        surface = self._array(entry, "surface", self.dtype, (int(entry["surface_rows"]), columns))
+        sphere = self._array(entry, "sphere", self.dtype, (int(entry["sphere_rows"]), columns))
+        return surface, sphere
+
+    def images(self, indices, out=None):
+        sketches = [
+            self._array(self.index[idx], "sketch", np.dtype(np.uint8), (1, self.imsize, self.imsize)) for idx in indices
+        ]
+        colors = [
+            self._array(self.index[idx], "color_2d", np.dtype(np.uint8), (3, self.imsize, self.imsize))
+            for idx in indices
+        ]
+        return images_to_tensors(np.stack(sketches), np.stack(colors), out)
@@ -4,6 +4,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _linear_weight(layer):
+    # nn.utils.weight_norm keeps weight = g * v / ||v|| and only recomputes it in forward
+    if hasattr(layer, "weight_v"):
+        return layer.weight_v * (layer.weight_g / torch.norm(layer.weight_v, dim=1, keepdim=True))
+    return layer.weight
+
+
 class Decoder(nn.Module):
     def __init__(self, cfg):
         super(Decoder, self).__init__()
@@ -25,3 +32,18 @@ class Decoder(nn.Module):
         color_out = torch.sigmoid(color_out)  # output is always 0 ~ 1
 
         return color_out
+
+    # Latent-dependent part of the first layer, computed once per color code
+    # z_color: [B D] -> [B feat_ch]
+    def project_latent(self, z_color):
+        lin = self.color_net[0]
+        return F.linear(z_color, _linear_weight(lin)[:, : z_color.size(-1)], lin.bias)
+
+    # Same as forward(cat([z_color, shape_feat, p])) given the latent projection of every point
+    # proj: [N feat_ch] from project_latent, feat_p: [N C] = cat([shape_feat, p])
+    def forward_projected(self, proj, feat_p):
+        w = _linear_weight(self.color_net[0])
+        color_out = self.color_net[1:](proj + F.linear(feat_p, w[:, w.size(1) - feat_p.size(-1) :]))
+        color_out = torch.sigmoid(color_out)  # output is always 0 ~ 1
+
+        return color_out
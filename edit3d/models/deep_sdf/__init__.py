@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+from edit3d.models.deep_sdf.cache import *
 from edit3d.models.deep_sdf.data import *
+from edit3d.models.deep_sdf.decimate import *
 from edit3d.models.deep_sdf.mesh import *
 from edit3d.models.deep_sdf.colormesh import *
+from edit3d.models.deep_sdf.mesh_io import *
+from edit3d.models.deep_sdf.octree import *
+from edit3d.models.deep_sdf.ply import *
+from edit3d.models.deep_sdf.slabs import *
 from edit3d.models.deep_sdf.metrics.chamfer import *
 from edit3d.models.deep_sdf.utils import *
 from edit3d.models.deep_sdf.workspace import *
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# model -> (parameter versions, digest)
+_model_digests = weakref.WeakKeyDictionary()
+
+
+def model_digest(*models):
+    """
+    sha1 of the parameters and buffers of the models, i.e. of the checkpoint they were loaded from
+
+    The digest of a model is recomputed only after its parameters are updated in place.
+    """
+    digest = hashlib.sha1()
+    for model in models:
+        versions = tuple(tensor._version for tensor in model.state_dict().values())
+        cached = _model_digests.get(model)
+        if cached is None or cached[0] != versions:
+            model_hash = hashlib.sha1()
+            for name, tensor in model.state_dict().items():
+                model_hash.update(name.encode("utf-8"))
+                _update(model_hash, tensor)
+            cached = (versions, model_hash.hexdigest())
+            _model_digests[model] = cached
+        digest.update(cached[1].encode("ascii"))
+    return digest.hexdigest()
+
+
+def _update(digest, part):
+    if isinstance(part, torch.Tensor):
+        part = part.detach().cpu().numpy()
+    if isinstance(part, np.ndarray):
+        digest.update(("%s%s" % (part.dtype.str, part.shape)).encode("ascii"))
+        digest.update(np.ascontiguousarray(part).tobytes())
+    else:
+        digest.update(repr(part).encode("utf-8"))
+
+
+class ArtifactCache:
+    """
+    Content addressed on-disk store of SDF volumes, meshes and renders
+
+    Entries are files named by the sha1 of what they were computed from, e.g. (model_digest, latent, resolution).
+    Reads refresh the modification time of an entry and the least recently used entries are deleted once the
+    store holds more than max_bytes.
+    """
+
+    def __init__(self, root, max_bytes=4 * 2 ** 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """sha1 of tensors, arrays and any other values by repr"""
+        digest = hashlib.sha1()
+        for part in parts:
+            _update(digest, part)
+        return digest.hexdigest()
+
+    def path(self, key, ext):
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def lookup(self, key, ext):
+        """Path of the entry, or None if it is not cached"""
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key, ext, filename):
+        """Copy filename into the store"""
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # copy then rename, so that concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def fetch(self, key, ext, filename, make):
+        """Copy the entry to filename, or call make(filename) to write it and store it"""
+        cached = self.lookup(key, ext)
+        if cached is not None:
+            logger.debug("cache hit %s -> %s" % (cached, filename))
+            shutil.copyfile(cached, filename)
+        else:
+            make(filename)
+            self.store(key, ext, filename)
+        return filename
+
+    def array(self, key, make):
+        """The cached array, or make() stored as .npy"""
+        cached = self.lookup(key, ".npy")
+        if cached is not None:
+            logger.debug("cache hit %s" % cached)
+            return np.load(cached)
+        array = np.asarray(make())
+        path = self.path(key, ".npy")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        self.evict()
+        return array
+
+    def evict(self):
+        """Delete the least recently used entries until the store holds at most max_bytes"""
+        entries = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
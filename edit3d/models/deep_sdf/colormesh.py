@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 # Copyright 2004-2022 Facebook. All Rights Reserved.
 
+import collections
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import plyfile
 import skimage.measure
 import torch
 
@@ -28,7 +29,23 @@ def create_mesh(
     offset=None,
     scale=None,
     device=device,
+    octree_depth=0,
+    slab_size=None,
+    num_workers=1,
+    mc_workers=1,
+    mesh_format="ply",
+    lod_faces=(),
+    cache=None,
 ):
+    """
+    The SDF is decoded on the N^3 grid and meshed first, then the colors are decoded once at the exact vertices.
+    octree_depth > 0 decodes the grid coarse to fine from every 2^octree_depth points, see evaluate_sdf_octree.
+    Otherwise slab_size streams the grid through marching cubes in slabs, on num_workers threads, see
+    marching_cubes_slabs. mc_workers > 1 runs marching cubes over the decoded grid in blocks on that many processes,
+    see marching_cubes_blocks. mesh_format is the extension of the written file: ply, npz or glb, see write_mesh.
+    lod_faces, e.g. (50000, 10000, 2000), also writes <filename>_lod<faces> meshes decimated to those budgets.
+    cache, an ArtifactCache, keeps the decoded grids of the dense and octree paths by model, latent and N.
+    """
     start = time.time()
     ply_filename = filename
 
@@ -39,60 +56,145 @@ def create_mesh(
     voxel_origin = [-1, -1, -1]
     voxel_size = 2.0 / (N - 1)
 
-    overall_index = torch.arange(0, N ** 3, 1, out=torch.LongTensor())
-    # samples = torch.zeros(N ** 3, 4)
-    samples = torch.zeros(N ** 3, 7)  # xyz+sdf+color
+    shape_code = shape_code.to(device)
+
+    def decode(sample_subset):
+        return deep_sdf.utils.decode_colorsdf(deepsdf, shape_code, sample_subset).squeeze(1), None
+
+    if octree_depth == 0 and slab_size is not None:
+        verts, faces, _ = deep_sdf.slabs.marching_cubes_slabs(
+            decode, N, voxel_origin, voxel_size, slab_size, max_batch, num_workers=num_workers, device=device
+        )
+    else:
+
+        def decode_grid():
+            if octree_depth > 0:
+                sdf_values, _ = deep_sdf.octree.evaluate_sdf_octree(
+                    decode, N, voxel_origin, voxel_size, depth=octree_depth, max_batch=max_batch, device=device
+                )
+                return sdf_values
+            sdf_values = torch.empty(N ** 3)
+            queries = deep_sdf.utils.grid_queries(N, voxel_origin, voxel_size, max_batch, device=device)
+            for head, sample_subset in queries:
+                sdf, _ = decode(sample_subset)
+                sdf_values[head : head + sample_subset.size(0)] = sdf.detach().cpu()
+                if device == CUDA_DEVICE:
+                    del sample_subset
+                    torch.cuda.empty_cache()
+                    torch.cuda.synchronize()
+            return sdf_values.reshape(N, N, N)
+
+        if cache is not None:
+            sdf_key = cache.key("sdf", deep_sdf.cache.model_digest(deepsdf), shape_code, N, octree_depth)
+            sdf_values = torch.from_numpy(cache.array(sdf_key, lambda: decode_grid().numpy()))
+        else:
+            sdf_values = decode_grid()
+
+        if mc_workers > 1:
+            verts, faces = deep_sdf.slabs.marching_cubes_blocks(
+                sdf_values.data.cpu(), voxel_size, level=0.0, num_workers=mc_workers
+            )
+        else:
+            verts, faces, _, _ = skimage.measure.marching_cubes(
+                sdf_values.data.cpu().numpy(), level=0.0, spacing=[voxel_size] * 3
+            )
 
-    # transform first 3 columns
-    # to be the x, y, z index
-    samples[:, 2] = overall_index % N
-    samples[:, 1] = (overall_index.long() / N) % N
-    samples[:, 0] = ((overall_index.long() / N) / N) % N
+    end = time.time()
+    logger.info("sampling and marching cubes take: %f" % (end - start))
 
-    # transform first 3 columns
-    # to be the x, y, z coordinate
-    samples[:, 0] = (samples[:, 0] * voxel_size) + voxel_origin[2]
-    samples[:, 1] = (samples[:, 1] * voxel_size) + voxel_origin[1]
-    samples[:, 2] = (samples[:, 2] * voxel_size) + voxel_origin[0]
+    colors = decode_vertex_colors(
+        deepsdf, colorsdf, shape_code, color_code, verts + np.array(voxel_origin), max_batch, device=device
+    )
+    logger.info("vertex colors take: %f" % (time.time() - end))
 
-    num_samples = N ** 3
+    write_mesh_ply(verts, faces, colors, voxel_origin, ply_filename + "." + mesh_format, offset, scale, lod_faces)
 
-    samples.requires_grad = False
 
-    head = 0
+@torch.no_grad()
+def create_meshes(
+    deepsdf,
+    colorsdf,
+    jobs,
+    N=256,
+    max_batch=32 ** 3,
+    offset=None,
+    scale=None,
+    device=device,
+    latents_per_batch=4,
+    num_workers=2,
+    mesh_format="ply",
+    lod_faces=(),
+):
+    """
+    create_mesh for many latents in one job
 
-    while head < num_samples:
-        sample_subset = samples[head : min(head + max_batch, num_samples), 0:3]
+    The SDF grids of latents_per_batch latents are decoded together, max_batch points per decoder call, on the grid
+    coordinates of grid_queries. Marching cubes, vertex colors and .ply writing of the decoded grids run on
+    num_workers threads while the next latents are decoded; at most 2 * num_workers grids wait for them.
+    A latent whose grid the surface does not cross is logged and skipped.
 
-        sample_subset = sample_subset.to(device)
+    :param jobs: list of (shape_code, color_code, filename), filename without the extension
+    :param lod_faces: face budgets of the decimated meshes to write next to each mesh, see create_mesh
+    """
+    start = time.time()
+    deepsdf.eval()
+    colorsdf.eval()
 
-        sdf, color3d = deep_sdf.utils.decode_colorsdf2(deepsdf, colorsdf, shape_code, color_code, sample_subset)
-        sdf = sdf.squeeze(1).detach().cpu()
-        samples[head : min(head + max_batch, num_samples), 3] = sdf
-        samples[head : min(head + max_batch, num_samples), 4:] = color3d
-        head += max_batch
-        if device == CUDA_DEVICE:
-            del sample_subset
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
+    voxel_origin = [-1, -1, -1]
+    voxel_size = 2.0 / (N - 1)
 
-    sdf_values = samples[:, 3]
-    sdf_values = sdf_values.reshape(N, N, N)
-    color_values = samples[:, 4:]
-    color_values = color_values.reshape(N, N, N, 3)
+    def mesh_job(sdf_values, shape_code, color_code, filename):
+        try:
+            verts, faces, _, _ = skimage.measure.marching_cubes(sdf_values, level=0.0, spacing=[voxel_size] * 3)
+        except ValueError:
+            logger.warning("no surface in the grid of %s, skipped" % filename)
+            return
+        colors = decode_vertex_colors(
+            deepsdf, colorsdf, shape_code, color_code, verts + np.array(voxel_origin), max_batch, device=device
+        )
+        write_mesh_ply(verts, faces, colors, voxel_origin, filename + "." + mesh_format, offset, scale, lod_faces)
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for head in range(0, len(jobs), latents_per_batch):
+            batch_jobs = jobs[head : head + latents_per_batch]
+            num_latents = len(batch_jobs)
+            shape_codes = torch.cat([shape_code.reshape(1, -1).to(device) for shape_code, _, _ in batch_jobs], dim=0)
+            sdf_values = torch.empty(num_latents, N ** 3)
+            points_per_call = max(max_batch // num_latents, 1)
+            queries = deep_sdf.utils.grid_queries(N, voxel_origin, voxel_size, points_per_call, device=device)
+            for point_head, points in queries:
+                inputs = torch.cat(
+                    [shape_codes.repeat_interleave(points.size(0), dim=0), points.repeat(num_latents, 1)], dim=1
+                )
+                sdf, _ = deepsdf(inputs)
+                sdf_values[:, point_head : point_head + points_per_call] = sdf.reshape(num_latents, -1).cpu()
+
+            for (shape_code, color_code, filename), sdf in zip(batch_jobs, sdf_values):
+                while len(pending) >= 2 * num_workers:
+                    pending.popleft().result()
+                pending.append(pool.submit(mesh_job, sdf.reshape(N, N, N).numpy(), shape_code, color_code, filename))
+        while pending:
+            pending.popleft().result()
+
+    logger.info("%d meshes take: %f" % (len(jobs), time.time() - start))
+
+
+@torch.no_grad()
+def decode_vertex_colors(deepsdf, colorsdf, shape_code, color_code, points, max_batch=32 ** 3, device=device):
+    """
+    Decode the colors at the mesh vertices
 
-    end = time.time()
-    logger.info("sampling takes: %f" % (end - start))
-
-    convert_sdf_samples_to_ply(
-        sdf_values.data.cpu(),
-        color_values.data.cpu(),
-        voxel_origin,
-        voxel_size,
-        ply_filename + ".ply",
-        offset,
-        scale,
-    )
+    :param points: (n,3) float array of vertex positions in the coordinates the decoders were queried with
+    :return: (n,3) float array of colors, in the channel order of convert_sdf_samples_to_ply
+    """
+    points = torch.from_numpy(np.ascontiguousarray(points, dtype=np.float32))
+    colors = torch.empty(points.size(0), 3)
+    for head in range(0, points.size(0), max_batch):
+        sample_subset = points[head : head + max_batch].to(device)
+        _, color3d = deep_sdf.utils.decode_colorsdf2(deepsdf, colorsdf, shape_code, color_code, sample_subset)
+        colors[head : head + max_batch] = color3d.detach().cpu()
+    return colors.numpy()
 
 
 def convert_sdf_samples_to_ply(
@@ -122,17 +224,31 @@ def convert_sdf_samples_to_ply(
     verts, faces, normals, values = skimage.measure.marching_cubes(
         numpy_3d_sdf_tensor, spacing=[voxel_size] * 3
     )
-    num_verts = verts.shape[0]
-    num_faces = faces.shape[0]
-
     # for each vertice, find the nearest points in numpy-3d-sdf-tensor, and get the color
     idx = (verts / voxel_size).astype(int)
     colors = numpy_3d_color_tensor[idx[:, 0], idx[:, 1], idx[:, 2]]
+
+    write_mesh_ply(verts, faces, colors, voxel_grid_origin, ply_filename_out, offset, scale)
+
+    logging.debug("converting to ply format and writing to file took {} s".format(time.time() - start_time))
+
+
+def write_mesh_ply(verts, faces, colors, voxel_grid_origin, ply_filename_out, offset=None, scale=None, lod_faces=()):
+    """
+    Write marching cubes output with vertex colors to .ply, .npz or .glb by the extension of ply_filename_out
+
+    :verts: (n,3) array of vertices in voxel grid coordinates, faces: (m,3) array, colors: (n,3) float array
+    :lod_faces: face budgets of decimated copies, written to <ply_filename_out>_lod<faces> with the same extension
+    """
+    for target_faces, (lod_verts, lod_mesh_faces, lod_colors) in zip(
+        lod_faces, deep_sdf.decimate.mesh_lods(verts, faces, lod_faces, colors)
+    ):
+        root, ext = os.path.splitext(ply_filename_out)
+        lod_filename = "%s_lod%d%s" % (root, target_faces, ext)
+        write_mesh_ply(lod_verts, lod_mesh_faces, lod_colors, voxel_grid_origin, lod_filename, offset, scale)
+
     colors = np.uint8(colors * 255)
     colors = colors[:, ::-1]
-    colors_tuple = np.zeros((num_verts,), dtype=[("red", "u1"), ("green", "u1"), ("blue", "u1")])
-    for i in range(0, num_verts):
-        colors_tuple[i] = tuple(colors[i, :])
 
     # transform from voxel coordinates to camera coordinates
     # note x and y are flipped in the output of marching_cubes
@@ -147,30 +263,5 @@ def convert_sdf_samples_to_ply(
     if offset is not None:
         mesh_points = mesh_points - offset
 
-    # try writing to the ply file
-
-    verts_tuple = np.zeros((num_verts,), dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
-
-    for i in range(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
-
-    verts_all = np.empty(num_verts, verts_tuple.dtype.descr + colors_tuple.dtype.descr)
-    for prop in verts_tuple.dtype.names:
-        verts_all[prop] = verts_tuple[prop]
-    for prop in colors_tuple.dtype.names:
-        verts_all[prop] = colors_tuple[prop]
-
-    faces_building = []
-    for i in range(0, num_faces):
-        faces_building.append(((faces[i, :].tolist(),)))
-    faces_tuple = np.array(faces_building, dtype=[("vertex_indices", "i4", (3,))])
-
-    # el_verts = plyfile.PlyElement.describe(verts_tuple, "vertex")
-    el_verts = plyfile.PlyElement.describe(verts_all, "vertex")
-    el_faces = plyfile.PlyElement.describe(faces_tuple, "face")
-
-    ply_data = plyfile.PlyData([el_verts, el_faces])
     logging.debug("saving mesh to %s" % (ply_filename_out))
-    ply_data.write(ply_filename_out)
-
-    logging.debug("converting to ply format and writing to file took {} s".format(time.time() - start_time))
+    deep_sdf.mesh_io.write_mesh(ply_filename_out, mesh_points, faces, colors)
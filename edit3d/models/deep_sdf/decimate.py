@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import logging
+
+import numpy as np
+import scipy.sparse
+
+logger = logging.getLogger(__name__)
+
+
+def decimate_mesh(verts, faces, target_faces, colors=None, boundary_weight=10.0, max_rounds=100, max_passes=8):
+    """
+    Quadric error decimation of a triangle mesh down to at most target_faces faces
+
+    Each round collapses a batch of edges at once instead of one edge at a time: the vertex quadrics are summed
+    from the area weighted face planes (plus planes through the boundary edges, weighted by boundary_weight),
+    every edge gets the position minimizing the quadric error of its two endpoints, and up to max_passes times the
+    cheapest edges within one ring of their endpoints are collapsed, so that no two collapses touch the same face.
+    Collapses that would make the mesh non-manifold or flip a face are skipped.
+
+    :param verts: (n,3) float array, faces: (m,3) int array
+    :param colors: optional (n,C) array of vertex values, interpolated along the collapsed edges
+    :return: verts (n',3), faces (m',3), colors (n',C) or None, without unused vertices
+    """
+    verts = np.asarray(verts, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    values = None if colors is None else np.asarray(colors, dtype=np.float64)
+    # edges whose collapse was rejected, skipped until a round finds nothing else to collapse
+    blocked = np.zeros((0, 2), dtype=np.int64)
+    retried = False
+
+    for _ in range(max_rounds):
+        if len(faces) <= target_faces:
+            break
+        edges, edge_faces = _edges(faces, len(verts))
+        quadrics = _vertex_quadrics(verts, faces, edges, edge_faces, boundary_weight)
+        positions, costs = _optimal_positions(verts, quadrics, edges)
+        costs[np.isin(_edge_keys(edges, len(verts)), _edge_keys(blocked, len(verts)))] = np.inf
+
+        # an interior collapse removes two faces
+        need = (len(faces) - target_faces + 1) // 2
+        selected, rejected = _select_collapses(verts, faces, edges, edge_faces, positions, costs, need, max_passes)
+        blocked = np.concatenate([blocked, edges[rejected]])
+        if len(selected) == 0:
+            if retried or len(blocked) == 0:
+                break
+            blocked, retried = blocked[:0], True
+            continue
+        retried = False
+
+        keep, drop = edges[selected, 0], edges[selected, 1]
+        if values is not None:
+            direction = verts[drop] - verts[keep]
+            t = np.einsum("ij,ij->i", positions[selected] - verts[keep], direction)
+            t = np.clip(t / np.maximum(np.einsum("ij,ij->i", direction, direction), 1e-30), 0.0, 1.0)[:, None]
+            values[keep] = (1 - t) * values[keep] + t * values[drop]
+        verts = verts.copy()
+        verts[keep] = positions[selected]
+        remap = np.arange(len(verts))
+        remap[drop] = keep
+        faces = remap[faces]
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+
+        # drop the collapsed vertices
+        used, faces = np.unique(faces, return_inverse=True)
+        faces = faces.reshape(-1, 3)
+        new_index = np.full(len(verts), -1, dtype=np.int64)
+        new_index[used] = np.arange(len(used))
+        verts = verts[used]
+        values = None if values is None else values[used]
+        blocked = np.sort(new_index[blocked], axis=1)
+        blocked = blocked[blocked[:, 0] >= 0]
+
+    logger.info("decimate: %d vertices, %d faces" % (len(verts), len(faces)))
+    return verts, faces, None if values is None else values.astype(np.asarray(colors).dtype)
+
+
+def mesh_lods(verts, faces, lod_faces, colors=None):
+    """
+    Levels of detail of a mesh, for face budgets lod_faces, each decimated from the next finer level
+
+    :return: list of (verts, faces, colors) in the order of lod_faces
+    """
+    lods = {}
+    level = (verts, faces, colors)
+    for target_faces in sorted(lod_faces, reverse=True):
+        level = decimate_mesh(level[0], level[1], target_faces, colors=level[2])
+        lods[target_faces] = level
+    return [lods[target_faces] for target_faces in lod_faces]
+
+
+def _edges(faces, num_verts):
+    # unique undirected edges (E,2) with i < j, sorted, and the number of faces around each
+    edge_keys, edge_faces = np.unique(_half_edge_keys(faces, num_verts), return_counts=True)
+    return np.stack([edge_keys // num_verts, edge_keys % num_verts], axis=1), edge_faces
+
+
+def _edge_keys(edges, num_verts):
+    return edges[:, 0] * num_verts + edges[:, 1]
+
+
+def _select_collapses(verts, faces, edges, edge_faces, positions, costs, need, max_passes):
+    # at most need edges to collapse together, and the edges rejected by the checks
+    rank = np.empty(len(edges), dtype=np.int64)
+    rank[np.argsort(costs, kind="stable")] = np.arange(len(edges))
+    eligible = np.isfinite(costs)
+    locked = np.zeros(len(verts), dtype=bool)  # endpoints of the selected edges and their neighbors
+    adjacency = scipy.sparse.coo_matrix(
+        (np.ones(2 * len(edges)), (edges.reshape(-1), edges[:, ::-1].reshape(-1))), shape=(len(verts), len(verts))
+    ).tocsr()
+    selected, rejected = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for _ in range(max_passes):
+        candidates = eligible & ~locked[edges[:, 0]] & ~locked[edges[:, 1]]
+        if need <= 0 or not candidates.any():
+            break
+        # the cheapest candidate within one ring of both of its endpoints
+        candidate_rank = np.where(candidates, rank, len(edges))
+        vertex_rank = np.full(len(verts), len(edges), dtype=np.int64)
+        np.minimum.at(vertex_rank, edges[:, 0], candidate_rank)
+        np.minimum.at(vertex_rank, edges[:, 1], candidate_rank)
+        ring_rank = vertex_rank.copy()
+        np.minimum.at(ring_rank, edges[:, 0], vertex_rank[edges[:, 1]])
+        np.minimum.at(ring_rank, edges[:, 1], vertex_rank[edges[:, 0]])
+        chosen = candidates & (ring_rank[edges[:, 0]] == rank) & (ring_rank[edges[:, 1]] == rank)
+        chosen = np.nonzero(chosen)[0]
+        chosen = chosen[np.argsort(rank[chosen])][:need]
+
+        valid = _link_condition(adjacency, edges[chosen], edge_faces[chosen])
+        valid[valid] = _no_flips(verts, faces, edges[chosen[valid]], positions[chosen[valid]])
+        eligible[chosen] = False
+        rejected.append(chosen[~valid])
+        chosen = chosen[valid]
+        selected.append(chosen)
+        need -= len(chosen)
+
+        endpoints = np.zeros(len(verts), dtype=bool)
+        endpoints[edges[chosen].reshape(-1)] = True
+        locked |= endpoints
+        locked[edges[endpoints[edges[:, 0]], 1]] = True
+        locked[edges[endpoints[edges[:, 1]], 0]] = True
+    return np.concatenate(selected), np.concatenate(rejected)
+
+
+def _half_edge_keys(faces, num_verts):
+    half_edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    return half_edges[:, 0] * num_verts + half_edges[:, 1]
+
+
+def _vertex_quadrics(verts, faces, edges, edge_faces, boundary_weight):
+    v0, v1, v2 = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+    normals = np.cross(v1 - v0, v2 - v0)
+    double_area = np.linalg.norm(normals, axis=1)
+    normals = normals / np.maximum(double_area, 1e-30)[:, None]
+    planes = np.concatenate([normals, -np.einsum("ij,ij->i", normals, v0)[:, None]], axis=1)
+    face_quadrics = (planes[:, :, None] * planes[:, None, :] * (double_area / 2)[:, None, None]).reshape(-1, 16)
+    vertex_ids = faces.reshape(-1)
+    face_quadrics = np.repeat(face_quadrics, 3, axis=0)
+
+    boundary = edges[edge_faces == 1]
+    if len(boundary) > 0 and boundary_weight > 0:
+        # plane through each boundary edge, perpendicular to the face it belongs to
+        half_keys = _half_edge_keys(faces, len(verts))
+        on_boundary = np.nonzero(np.isin(half_keys, boundary[:, 0] * len(verts) + boundary[:, 1]))[0]
+        # boundary is sorted by key, as returned by np.unique
+        boundary_face = on_boundary[np.argsort(half_keys[on_boundary])] // 3
+        direction = verts[boundary[:, 1]] - verts[boundary[:, 0]]
+        length2 = np.einsum("ij,ij->i", direction, direction)
+        side = np.cross(direction, normals[boundary_face])
+        side = side / np.maximum(np.linalg.norm(side, axis=1), 1e-30)[:, None]
+        side_planes = np.concatenate([side, -np.einsum("ij,ij->i", side, verts[boundary[:, 0]])[:, None]], axis=1)
+        side_quadrics = side_planes[:, :, None] * side_planes[:, None, :] * (boundary_weight * length2)[:, None, None]
+        vertex_ids = np.concatenate([vertex_ids, boundary.reshape(-1)])
+        face_quadrics = np.concatenate([face_quadrics, np.repeat(side_quadrics.reshape(-1, 16), 2, axis=0)])
+
+    quadrics = np.stack(
+        [np.bincount(vertex_ids, weights=face_quadrics[:, k], minlength=len(verts)) for k in range(16)], axis=1
+    )
+    return quadrics.reshape(-1, 4, 4)
+
+
+def _optimal_positions(verts, quadrics, edges):
+    # position minimizing v^T Q v over each edge, falling back to the endpoints and midpoint when Q is singular
+    edge_quadrics = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    A, b = edge_quadrics[:, :3, :3], edge_quadrics[:, :3, 3]
+    v0, v1 = verts[edges[:, 0]], verts[edges[:, 1]]
+    candidates = [v0, v1, (v0 + v1) / 2]
+    det = np.linalg.det(A)
+    scale = np.abs(A).sum(axis=(1, 2)) ** 3
+    solvable = np.abs(det) > 1e-12 * np.maximum(scale, 1e-30)
+    optimal = (v0 + v1) / 2
+    optimal[solvable] = np.linalg.solve(A[solvable], -b[solvable][:, :, None])[:, :, 0]
+    # far away optima come from nearly flat regions, where any point on the edge is as good
+    length = np.linalg.norm(v1 - v0, axis=1)
+    solvable &= np.linalg.norm(optimal - (v0 + v1) / 2, axis=1) <= length
+    candidates.append(np.where(solvable[:, None], optimal, (v0 + v1) / 2))
+
+    best, best_cost = None, None
+    for position in candidates:
+        p = np.concatenate([position, np.ones((len(position), 1))], axis=1)
+        cost = np.einsum("ij,ijk,ik->i", p, edge_quadrics, p)
+        if best is None:
+            best, best_cost = position, cost
+        else:
+            better = cost < best_cost
+            best = np.where(better[:, None], position, best)
+            best_cost = np.where(better, cost, best_cost)
+    return best, best_cost
+
+
+def _link_condition(adjacency, pairs, pair_faces):
+    # a collapse keeps the mesh manifold when the endpoints share no neighbors but the opposite vertices
+    common = np.asarray(adjacency[pairs[:, 0]].multiply(adjacency[pairs[:, 1]]).sum(axis=1)).reshape(-1)
+    return common == pair_faces
+
+
+def _no_flips(verts, faces, pairs, positions):
+    # reject the collapses that turn a face around
+    moved = verts.copy()
+    moved[pairs[:, 0]] = positions
+    moved[pairs[:, 1]] = positions
+    touched = np.zeros(len(verts), dtype=bool)
+    touched[pairs.reshape(-1)] = True
+    affected = faces[touched[faces].any(axis=1)]
+    before = np.cross(verts[affected[:, 1]] - verts[affected[:, 0]], verts[affected[:, 2]] - verts[affected[:, 0]])
+    after = np.cross(moved[affected[:, 1]] - moved[affected[:, 0]], moved[affected[:, 2]] - moved[affected[:, 0]])
+    # the faces around a collapsed edge disappear, the others must keep their orientation
+    collapse = np.full(len(verts), -1, dtype=np.int64)
+    collapse[pairs[:, 0]] = np.arange(len(pairs))
+    collapse[pairs[:, 1]] = np.arange(len(pairs))
+    corner_collapse = collapse[affected]
+    vanishing = (corner_collapse >= 0) & (corner_collapse == corner_collapse[:, [1, 2, 0]])
+    vanishing = vanishing.any(axis=1)
+    flipped = (np.einsum("ij,ij->i", before, after) <= 0) & ~vanishing
+    bad = np.zeros(len(verts), dtype=bool)
+    bad[affected[flipped].reshape(-1)] = True
+    return ~(bad[pairs[:, 0]] | bad[pairs[:, 1]])
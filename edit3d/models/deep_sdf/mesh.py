@@ -2,10 +2,10 @@
 # Copyright 2004-present Facebook. All Rights Reserved.
 
 import logging
+import os
 import time
 
 import numpy as np
-import plyfile
 import skimage.measure
 import torch
 
@@ -13,7 +13,31 @@ from edit3d import CUDA_DEVICE
 from edit3d.models import deep_sdf
 
 
-def create_mesh(decoder, latent_vec, filename, N=256, max_batch=32 ** 3, offset=None, scale=None, device=CUDA_DEVICE):
+def create_mesh(
+    decoder,
+    latent_vec,
+    filename,
+    N=256,
+    max_batch=32 ** 3,
+    offset=None,
+    scale=None,
+    device=CUDA_DEVICE,
+    octree_depth=0,
+    slab_size=None,
+    num_workers=1,
+    mc_workers=1,
+    mesh_format="ply",
+    lod_faces=(),
+    cache=None,
+):
+    """
+    octree_depth > 0 decodes the grid coarse to fine from every 2^octree_depth points, see evaluate_sdf_octree.
+    Otherwise slab_size streams the grid through marching cubes in slabs, on num_workers threads, see
+    marching_cubes_slabs. mc_workers > 1 runs marching cubes over the decoded grid in blocks on that many processes,
+    see marching_cubes_blocks. mesh_format is the extension of the written file: ply, npz or glb, see write_mesh.
+    lod_faces, e.g. (50000, 10000, 2000), also writes <filename>_lod<faces> meshes decimated to those budgets.
+    cache, an ArtifactCache, keeps the decoded grids of the dense and octree paths by model, latent and N.
+    """
     start = time.time()
     ply_filename = filename
 
@@ -23,43 +47,38 @@ def create_mesh(decoder, latent_vec, filename, N=256, max_batch=32 ** 3, offset=
     voxel_origin = [-1, -1, -1]
     voxel_size = 2.0 / (N - 1)
 
-    overall_index = torch.arange(0, N ** 3, 1, out=torch.LongTensor())
-    samples = torch.zeros(N ** 3, 4)
-
-    # transform first 3 columns
-    # to be the x, y, z index
-    samples[:, 2] = overall_index % N
-    samples[:, 1] = (overall_index.long() / N) % N
-    samples[:, 0] = ((overall_index.long() / N) / N) % N
-
-    # transform first 3 columns
-    # to be the x, y, z coordinate
-    samples[:, 0] = (samples[:, 0] * voxel_size) + voxel_origin[2]
-    samples[:, 1] = (samples[:, 1] * voxel_size) + voxel_origin[1]
-    samples[:, 2] = (samples[:, 2] * voxel_size) + voxel_origin[0]
-
-    num_samples = N ** 3
+    def decode(sample_subset):
+        return deep_sdf.utils.decode_colorsdf(decoder, latent_vec, sample_subset).squeeze(1), None
 
-    samples.requires_grad = False
-
-    head = 0
-
-    while head < num_samples:
-        sample_subset = samples[head : min(head + max_batch, num_samples), 0:3]
-
-        sample_subset = sample_subset.to(device)
-
-        samples[head : min(head + max_batch, num_samples), 3] = (
-            deep_sdf.utils.decode_colorsdf(decoder, latent_vec, sample_subset).squeeze(1).detach().cpu()
+    if octree_depth == 0 and slab_size is not None:
+        verts, faces, _ = deep_sdf.slabs.marching_cubes_slabs(
+            decode, N, voxel_origin, voxel_size, slab_size, max_batch, num_workers=num_workers, device=device
         )
-        head += max_batch
-        if device == CUDA_DEVICE:
-            del sample_subset
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-
-    sdf_values = samples[:, 3]
-    sdf_values = sdf_values.reshape(N, N, N)
+        print("sampling and marching cubes take: %f" % (time.time() - start))
+        write_mesh_ply(verts, faces, voxel_origin, ply_filename + "." + mesh_format, offset, scale, lod_faces)
+        return
+
+    def decode_grid():
+        if octree_depth > 0:
+            sdf_values, _ = deep_sdf.octree.evaluate_sdf_octree(
+                decode, N, voxel_origin, voxel_size, depth=octree_depth, max_batch=max_batch, device=device
+            )
+            return sdf_values
+        sdf_values = torch.empty(N ** 3)
+        for head, sample_subset in deep_sdf.utils.grid_queries(N, voxel_origin, voxel_size, max_batch, device=device):
+            sdf, _ = decode(sample_subset)
+            sdf_values[head : head + sample_subset.size(0)] = sdf.detach().cpu()
+            if device == CUDA_DEVICE:
+                del sample_subset
+                torch.cuda.empty_cache()
+                torch.cuda.synchronize()
+        return sdf_values.reshape(N, N, N)
+
+    if cache is not None:
+        sdf_key = cache.key("sdf", deep_sdf.cache.model_digest(decoder), latent_vec, N, octree_depth)
+        sdf_values = torch.from_numpy(cache.array(sdf_key, lambda: decode_grid().numpy()))
+    else:
+        sdf_values = decode_grid()
 
     end = time.time()
     print("sampling takes: %f" % (end - start))
@@ -68,9 +87,11 @@ def create_mesh(decoder, latent_vec, filename, N=256, max_batch=32 ** 3, offset=
         sdf_values.data.cpu(),
         voxel_origin,
         voxel_size,
-        ply_filename + ".ply",
+        ply_filename + "." + mesh_format,
         offset,
         scale,
+        mc_workers,
+        lod_faces,
     )
 
 
@@ -81,6 +102,8 @@ def convert_sdf_samples_to_ply(
     ply_filename_out,
     offset=None,
     scale=None,
+    mc_workers=1,
+    lod_faces=(),
 ):
     """
     Convert sdf samples to .ply
@@ -89,6 +112,8 @@ def convert_sdf_samples_to_ply(
     :voxel_grid_origin: a list of three floats: the bottom, left, down origin of the voxel grid
     :voxel_size: float, the size of the voxels
     :ply_filename_out: string, path of the filename to save to
+    :mc_workers: int, processes to run marching cubes on, in blocks along the first axis when > 1
+    :lod_faces: face budgets of decimated copies to write, see write_mesh_ply
 
     This function adapted from: https://github.com/RobotLocomotion/spartan
     """
@@ -96,9 +121,33 @@ def convert_sdf_samples_to_ply(
 
     numpy_3d_sdf_tensor = pytorch_3d_sdf_tensor.numpy()
 
-    verts, faces, normals, values = skimage.measure.marching_cubes(
-        numpy_3d_sdf_tensor, level=0.0, spacing=[voxel_size] * 3
-    )
+    if mc_workers > 1:
+        verts, faces = deep_sdf.slabs.marching_cubes_blocks(
+            numpy_3d_sdf_tensor, voxel_size, level=0.0, num_workers=mc_workers
+        )
+    else:
+        verts, faces, normals, values = skimage.measure.marching_cubes(
+            numpy_3d_sdf_tensor, level=0.0, spacing=[voxel_size] * 3
+        )
+
+    write_mesh_ply(verts, faces, voxel_grid_origin, ply_filename_out, offset, scale, lod_faces)
+
+    logging.debug("converting to ply format and writing to file took {} s".format(time.time() - start_time))
+
+
+def write_mesh_ply(verts, faces, voxel_grid_origin, ply_filename_out, offset=None, scale=None, lod_faces=()):
+    """
+    Write marching cubes output to .ply, .npz or .glb by the extension of ply_filename_out
+
+    :verts: (n,3) array of vertices in voxel grid coordinates, faces: (m,3) array
+    :lod_faces: face budgets of decimated copies, written to <ply_filename_out>_lod<faces> with the same extension
+    """
+    for target_faces, (lod_verts, lod_mesh_faces, _) in zip(
+        lod_faces, deep_sdf.decimate.mesh_lods(verts, faces, lod_faces)
+    ):
+        root, ext = os.path.splitext(ply_filename_out)
+        lod_filename = "%s_lod%d%s" % (root, target_faces, ext)
+        write_mesh_ply(lod_verts, lod_mesh_faces, voxel_grid_origin, lod_filename, offset, scale)
 
     # transform from voxel coordinates to camera coordinates
     # note x and y are flipped in the output of marching_cubes
@@ -113,26 +162,5 @@ def convert_sdf_samples_to_ply(
     if offset is not None:
         mesh_points = mesh_points - offset
 
-    # try writing to the ply file
-
-    num_verts = verts.shape[0]
-    num_faces = faces.shape[0]
-
-    verts_tuple = np.zeros((num_verts,), dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
-
-    for i in range(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
-
-    faces_building = []
-    for i in range(0, num_faces):
-        faces_building.append(((faces[i, :].tolist(),)))
-    faces_tuple = np.array(faces_building, dtype=[("vertex_indices", "i4", (3,))])
-
-    el_verts = plyfile.PlyElement.describe(verts_tuple, "vertex")
-    el_faces = plyfile.PlyElement.describe(faces_tuple, "face")
-
-    ply_data = plyfile.PlyData([el_verts, el_faces])
     logging.debug("saving mesh to %s" % (ply_filename_out))
-    ply_data.write(ply_filename_out)
-
-    logging.debug("converting to ply format and writing to file took {} s".format(time.time() - start_time))
+    deep_sdf.mesh_io.write_mesh(ply_filename_out, mesh_points, faces)
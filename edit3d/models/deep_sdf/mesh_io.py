@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from edit3d.models.deep_sdf.ply import load_ply, write_ply
+
+_GLB_MAGIC = 0x46546C67
+_GLB_JSON = 0x4E4F534A
+_GLB_BIN = 0x004E4942
+_GLTF_COMPONENT_TYPES = {5121: np.uint8, 5123: np.uint16, 5125: np.uint32, 5126: np.float32}
+_GLTF_NUM_COMPONENTS = {"SCALAR": 1, "VEC3": 3, "VEC4": 4}
+
+
+def write_mesh(filename, mesh_points, faces, colors=None, **kwargs):
+    """
+    Write a triangle mesh in the format given by the extension of filename: .ply, .npz or .glb
+
+    :param mesh_points: (n,3) float array, faces: (m,3) int array, colors: optional (n,3) uint8 array
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".ply":
+        write_ply(filename, mesh_points, faces, colors, **kwargs)
+    elif ext == ".npz":
+        write_npz(filename, mesh_points, faces, colors, **kwargs)
+    elif ext == ".glb":
+        write_glb(filename, mesh_points, faces, colors)
+    else:
+        raise ValueError("Unknown mesh format: %s" % filename)
+
+
+def load_mesh(filename):
+    """
+    Load a triangle mesh written by write_mesh
+
+    :return: (n,3) float32 vertices, (m,3) int64 faces, (n,3) uint8 colors or None
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".ply":
+        return load_ply(filename)
+    elif ext == ".npz":
+        return load_npz(filename)
+    elif ext == ".glb":
+        return load_glb(filename)
+    raise ValueError("Unknown mesh format: %s" % filename)
+
+
+def load_trimesh(filename):
+    """Load a mesh written by write_mesh as a trimesh.Trimesh, e.g. for compute_trimesh_chamfer"""
+    import trimesh
+
+    vertices, faces, colors = load_mesh(filename)
+    return trimesh.Trimesh(vertices=vertices, faces=faces, vertex_colors=colors, process=False)
+
+
+def write_npz(filename, mesh_points, faces, colors=None, quantize_bits=16):
+    """
+    Write a triangle mesh as compressed .npz
+
+    Positions are stored as unsigned integers of quantize_bits bits over the bounding box of the mesh, i.e. with an
+    error of at most half a step of the box size / (2^quantize_bits - 1), or as float16 if quantize_bits is None.
+    Faces are stored as int32 and colors as uint8.
+    """
+    mesh_points = np.asarray(mesh_points, dtype=np.float32)
+    arrays = {"faces": np.asarray(faces, dtype=np.int32)}
+    if quantize_bits is None:
+        arrays["vertices"] = mesh_points.astype(np.float16)
+    else:
+        levels = 2 ** quantize_bits - 1
+        bbox_min = mesh_points.min(axis=0) if len(mesh_points) > 0 else np.zeros(3, dtype=np.float32)
+        bbox_max = mesh_points.max(axis=0) if len(mesh_points) > 0 else np.zeros(3, dtype=np.float32)
+        step = np.maximum(bbox_max - bbox_min, np.finfo(np.float32).tiny) / levels
+        quantized = np.rint((mesh_points - bbox_min) / step)
+        arrays["vertices_quantized"] = quantized.astype(np.uint8 if quantize_bits <= 8 else np.uint16)
+        arrays["bbox_min"] = bbox_min.astype(np.float32)
+        arrays["step"] = step.astype(np.float32)
+    if colors is not None:
+        arrays["colors"] = np.asarray(colors, dtype=np.uint8)
+    np.savez_compressed(filename, **arrays)
+
+
+def load_npz(filename):
+    with np.load(filename) as data:
+        if "vertices" in data:
+            vertices = data["vertices"].astype(np.float32)
+        else:
+            vertices = data["vertices_quantized"].astype(np.float32) * data["step"] + data["bbox_min"]
+        faces = data["faces"].astype(np.int64)
+        colors = data["colors"] if "colors" in data else None
+    return vertices, faces, colors
+
+
+def write_glb(filename, mesh_points, faces, colors=None):
+    """
+    Write a triangle mesh as binary glTF 2.0: float32 positions, uint32 indices and normalized uint8 RGBA vertex
+    colors (COLOR_0) in one buffer
+    """
+    positions = np.ascontiguousarray(mesh_points, dtype=np.float32)
+    indices = np.ascontiguousarray(faces, dtype=np.uint32)
+    views = [(positions, 34962), (indices, 34963)]
+    accessors = [
+        {"componentType": 5126, "count": len(positions), "type": "VEC3"},
+        {"componentType": 5125, "count": indices.size, "type": "SCALAR"},
+    ]
+    if len(positions) > 0:
+        accessors[0]["min"] = positions.min(axis=0).tolist()
+        accessors[0]["max"] = positions.max(axis=0).tolist()
+    attributes = {"POSITION": 0}
+    if colors is not None:
+        rgba = np.full((len(positions), 4), 255, dtype=np.uint8)
+        rgba[:, :3] = colors
+        views.append((rgba, 34962))
+        accessors.append({"componentType": 5121, "normalized": True, "count": len(rgba), "type": "VEC4"})
+        attributes["COLOR_0"] = 2
+
+    buffer_views, chunks, offset = [], [], 0
+    for i, (array, target) in enumerate(views):
+        data = array.tobytes()
+        buffer_views.append({"buffer": 0, "byteOffset": offset, "byteLength": len(data), "target": target})
+        accessors[i]["bufferView"] = i
+        chunks.append(data + b"\x00" * (-len(data) % 4))
+        offset += len(chunks[-1])
+    gltf = {
+        "asset": {"version": "2.0"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": attributes, "indices": 1, "mode": 4}]}],
+        "accessors": accessors,
+        "bufferViews": buffer_views,
+        "buffers": [{"byteLength": offset}],
+    }
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+
+    with open(filename, "wb") as f:
+        f.write(struct.pack("<III", _GLB_MAGIC, 2, 12 + 8 + len(json_chunk) + 8 + offset))
+        f.write(struct.pack("<II", len(json_chunk), _GLB_JSON))
+        f.write(json_chunk)
+        f.write(struct.pack("<II", offset, _GLB_BIN))
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def load_glb(filename):
+    """Load the first triangle primitive of a .glb, e.g. one written by write_glb"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    magic, _, _ = struct.unpack_from("<III", data, 0)
+    if magic != _GLB_MAGIC:
+        raise ValueError("Not a binary glTF file: %s" % filename)
+    json_length, _ = struct.unpack_from("<II", data, 12)
+    gltf = json.loads(data[20 : 20 + json_length])
+    bin_offset = 20 + json_length + 8
+
+    def read_accessor(index):
+        accessor = gltf["accessors"][index]
+        view = gltf["bufferViews"][accessor["bufferView"]]
+        dtype = np.dtype(_GLTF_COMPONENT_TYPES[accessor["componentType"]])
+        num_components = _GLTF_NUM_COMPONENTS[accessor["type"]]
+        start = bin_offset + view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+        stride = view.get("byteStride", dtype.itemsize * num_components)
+        array = np.ndarray(
+            (accessor["count"], num_components),
+            dtype=dtype,
+            buffer=data,
+            offset=start,
+            strides=(stride, dtype.itemsize),
+        )
+        return array.copy()
+
+    primitive = gltf["meshes"][0]["primitives"][0]
+    vertices = read_accessor(primitive["attributes"]["POSITION"]).astype(np.float32)
+    faces = read_accessor(primitive["indices"]).reshape(-1, 3).astype(np.int64)
+    colors = None
+    if "COLOR_0" in primitive["attributes"]:
+        colors = read_accessor(primitive["attributes"]["COLOR_0"])[:, :3]
+        if colors.dtype == np.uint16:
+            colors = (colors >> 8).astype(np.uint8)
+        elif colors.dtype != np.uint8:
+            colors = np.uint8(np.clip(colors, 0.0, 1.0) * 255)
+    return vertices, faces, colors
@@ -5,6 +5,8 @@ import numpy as np
 from scipy.spatial import cKDTree as KDTree
 import trimesh
 
+from edit3d.models.deep_sdf.mesh_io import load_trimesh
+
 
 def compute_trimesh_chamfer(gt_points, gen_mesh, num_mesh_samples=30000):
     """
@@ -14,9 +16,13 @@ def compute_trimesh_chamfer(gt_points, gen_mesh, num_mesh_samples=30000):
                compute_metrics.ply for more documentation)
 
     gen_mesh: trimesh.base.Trimesh of output mesh from whichever autoencoding reconstruction
-              method (see compute_metrics.py for more)
+              method (see compute_metrics.py for more), or the path of a .ply, .npz or .glb mesh
+              written by write_mesh
 
     """
+    if isinstance(gen_mesh, str):
+        gen_mesh = load_trimesh(gen_mesh)
+
     # only need numpy array of points
     gt_points_np = gt_points.vertices
     mesh_max = np.amax(gt_points_np, axis=0)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+
+import torch
+import torch.nn.functional as F
+
+from edit3d import CUDA_DEVICE
+
+logger = logging.getLogger(__name__)
+
+
+@torch.no_grad()
+def evaluate_sdf_octree(
+    decode_fun,
+    N,
+    voxel_origin,
+    voxel_size,
+    depth=3,
+    max_batch=32 ** 3,
+    margin=1.5,
+    device=CUDA_DEVICE,
+):
+    """
+    Evaluate an SDF decoder on the N^3 grid of create_mesh, coarse to fine
+
+    The decoder is first evaluated every 2^depth grid points. At each level, only the cells whose corners change
+    sign or come within margin * cell diagonal of the surface are subdivided and decoded at twice the resolution.
+    The points of the other cells are trilinearly interpolated from their corners, which keeps their sign, so
+    marching cubes sees the same surface while the decoder cost grows with the surface area instead of the volume.
+
+    :param decode_fun: (P,3) points on device -> (P,) sdf, (P,C) extra values per point or None (e.g. colors)
+    :param voxel_origin: the (bottom, left, down) corner of the grid, as in create_mesh
+    :return: (N,N,N) sdf tensor, (N,N,N,C) tensor of the extra values or None, on the CPU. Extra values are only
+             set on the decoded points, which include the corners of every cell the surface crosses.
+    """
+    stride = 2 ** depth
+    n = (N - 1 + stride - 1) // stride + 1  # coarse points per axis, refined to at least N
+    fine_size = (n - 1) * stride + 1
+    origin = torch.tensor(voxel_origin, dtype=torch.float32)
+    extra_values = None
+    num_decoded = 0
+
+    def decode(idx, step):
+        nonlocal extra_values, num_decoded
+        sdf = torch.empty(idx.size(0))
+        for head in range(0, idx.size(0), max_batch):
+            idx_subset = idx[head : head + max_batch]
+            samples = (idx_subset * step).float() * voxel_size + origin
+            sdf_subset, extra = decode_fun(samples.to(device))
+            sdf[head : head + max_batch] = sdf_subset.reshape(-1).cpu()
+            if extra is not None:
+                if extra_values is None:
+                    extra_values = torch.zeros(fine_size, fine_size, fine_size, extra.size(-1))
+                fine_idx = idx_subset * step
+                extra_values[fine_idx[:, 0], fine_idx[:, 1], fine_idx[:, 2]] = extra.reshape(
+                    idx_subset.size(0), -1
+                ).cpu()
+        num_decoded += idx.size(0)
+        return sdf
+
+    # coarsest level: every point
+    axis = torch.arange(n)
+    idx = torch.stack(torch.meshgrid(axis, axis, axis, indexing="ij"), dim=-1).reshape(-1, 3)
+    sdf_values = decode(idx, stride).reshape(n, n, n)
+    decoded = torch.ones(n, n, n, dtype=torch.bool)
+
+    corners = torch.ones(1, 1, 3, 3, 3)
+    for level in range(depth):
+        step = stride >> level  # grid points between the current level points
+        bound = margin * math.sqrt(3) * step * voxel_size
+
+        # cells whose 8 corners are all decoded and that may contain the surface
+        sdf_cells = sdf_values[None, None]
+        cell_max = F.max_pool3d(sdf_cells, kernel_size=2, stride=1)
+        cell_min = -F.max_pool3d(-sdf_cells, kernel_size=2, stride=1)
+        cell_abs_min = -F.max_pool3d(-sdf_cells.abs(), kernel_size=2, stride=1)
+        cell_decoded = -F.max_pool3d(-decoded[None, None].float(), kernel_size=2, stride=1) > 0
+        near = cell_decoded & (((cell_max >= 0) & (cell_min <= 0)) | (cell_abs_min < bound))
+
+        # next level: interpolate everywhere, then decode the points of the near cells
+        n = 2 * n - 1
+        sdf_values = F.interpolate(sdf_cells, size=(n, n, n), mode="trilinear", align_corners=True)[0, 0]
+        next_decoded = torch.zeros(n, n, n, dtype=torch.bool)
+        next_decoded[::2, ::2, ::2] = decoded
+        in_near = F.conv_transpose3d(near.float(), corners, stride=2)[0, 0] > 0
+        todo = in_near & ~next_decoded
+        sdf_values[todo] = decode(torch.nonzero(todo, as_tuple=False), step // 2)
+        decoded = next_decoded | todo
+
+    logger.info("octree: decoded %d of %d grid points" % (num_decoded, N ** 3))
+    sdf_values = sdf_values[:N, :N, :N].contiguous()
+    if extra_values is not None:
+        extra_values = extra_values[:N, :N, :N].contiguous()
+    return sdf_values, extra_values
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+_VERTEX_PROPERTIES = [("x", "float"), ("y", "float"), ("z", "float")]
+_COLOR_PROPERTIES = [("red", "uchar"), ("green", "uchar"), ("blue", "uchar")]
+
+
+def write_ply(ply_filename_out, mesh_points, faces, colors=None, chunk_size=2 ** 18):
+    """
+    Write a triangle mesh as binary little-endian .ply, straight from numpy arrays
+
+    The file has the same content as plyfile.PlyData([vertex, face]).write() on the structured arrays that
+    convert_sdf_samples_to_ply used to build: float x, y, z (+ uchar red, green, blue) vertices and
+    "list uchar int vertex_indices" faces. Rows are encoded and written chunk_size at a time.
+
+    :param mesh_points: (n,3) float array of vertex positions, stored as float32
+    :param faces: (m,3) int array of vertex indices, stored as int32
+    :param colors: optional (n,3) uint8 array of vertex colors
+    """
+    vertex_dtype = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    properties = list(_VERTEX_PROPERTIES)
+    if colors is not None:
+        vertex_dtype += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+        properties += _COLOR_PROPERTIES
+    face_dtype = [("count", "u1"), ("vertex_indices", "<i4", (3,))]
+
+    header = ["ply", "format binary_little_endian 1.0", "element vertex %d" % len(mesh_points)]
+    header += ["property %s %s" % (ply_type, name) for name, ply_type in properties]
+    header += ["element face %d" % len(faces), "property list uchar int vertex_indices", "end_header"]
+
+    with open(ply_filename_out, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        for head in range(0, len(mesh_points), chunk_size):
+            verts_chunk = np.empty(min(chunk_size, len(mesh_points) - head), dtype=vertex_dtype)
+            verts_chunk["x"] = mesh_points[head : head + chunk_size, 0]
+            verts_chunk["y"] = mesh_points[head : head + chunk_size, 1]
+            verts_chunk["z"] = mesh_points[head : head + chunk_size, 2]
+            if colors is not None:
+                verts_chunk["red"] = colors[head : head + chunk_size, 0]
+                verts_chunk["green"] = colors[head : head + chunk_size, 1]
+                verts_chunk["blue"] = colors[head : head + chunk_size, 2]
+            f.write(verts_chunk.tobytes())
+        for head in range(0, len(faces), chunk_size):
+            faces_chunk = np.empty(min(chunk_size, len(faces) - head), dtype=face_dtype)
+            faces_chunk["count"] = 3
+            faces_chunk["vertex_indices"] = faces[head : head + chunk_size]
+            f.write(faces_chunk.tobytes())
+
+
+def load_ply(ply_filename):
+    """
+    Load a triangle mesh from .ply, reading binary little-endian files as written by write_ply straight into numpy
+
+    Other .ply files are read through plyfile.
+
+    :return: (n,3) float32 vertices, (m,3) int64 faces, (n,3) uint8 colors or None
+    """
+    with open(ply_filename, "rb") as f:
+        header = []
+        while not header or header[-1] != "end_header":
+            line = f.readline()
+            if not line:
+                raise ValueError("Incomplete .ply header: %s" % ply_filename)
+            header.append(line.decode("ascii").strip())
+        data = f.read()
+
+    properties = [tuple(line.split()[1:][::-1]) for line in header if line.startswith("property ")]
+    counts = [int(line.split()[2]) for line in header if line.startswith("element ")]
+    vertex_properties = properties[:-1]
+    if (
+        "format binary_little_endian 1.0" not in header
+        or len(counts) != 2
+        or vertex_properties not in (_VERTEX_PROPERTIES, _VERTEX_PROPERTIES + _COLOR_PROPERTIES)
+        or header[-2] != "property list uchar int vertex_indices"
+    ):
+        return _load_plyfile(ply_filename)
+
+    num_verts, num_faces = counts
+    vertex_dtype = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    if len(vertex_properties) > 3:
+        vertex_dtype += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    vertex_dtype = np.dtype(vertex_dtype)
+    face_dtype = np.dtype([("count", "u1"), ("vertex_indices", "<i4", (3,))])
+    verts = np.frombuffer(data, dtype=vertex_dtype, count=num_verts)
+    faces = np.frombuffer(data, dtype=face_dtype, count=num_faces, offset=num_verts * vertex_dtype.itemsize)
+    if (faces["count"] != 3).any():
+        return _load_plyfile(ply_filename)
+
+    vertices = np.stack([verts["x"], verts["y"], verts["z"]], axis=-1)
+    colors = None
+    if len(vertex_properties) > 3:
+        colors = np.stack([verts["red"], verts["green"], verts["blue"]], axis=-1)
+    return vertices, faces["vertex_indices"].astype(np.int64), colors
+
+
+def _load_plyfile(ply_filename):
+    import plyfile
+
+    ply_data = plyfile.PlyData.read(ply_filename)
+    verts = ply_data["vertex"]
+    vertices = np.stack([verts["x"], verts["y"], verts["z"]], axis=-1).astype(np.float32)
+    faces = np.stack(ply_data["face"]["vertex_indices"]).astype(np.int64)
+    colors = None
+    if "red" in verts.data.dtype.names:
+        colors = np.stack([verts["red"], verts["green"], verts["blue"]], axis=-1).astype(np.uint8)
+    return vertices, faces, colors
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import skimage.measure
+import torch
+
+from edit3d import CUDA_DEVICE
+
+logger = logging.getLogger(__name__)
+
+
+@torch.no_grad()
+def marching_cubes_slabs(
+    decode_fun,
+    N,
+    voxel_origin,
+    voxel_size,
+    slab_size=32,
+    max_batch=32 ** 3,
+    num_workers=1,
+    device=CUDA_DEVICE,
+):
+    """
+    Marching cubes over the N^3 grid of create_mesh, one slab of slab_size cells along the first axis at a time
+
+    Each slab decodes its (slab_size + 1) x N x N grid points, sharing one plane with the next slab, and runs
+    marching cubes on them; the vertices on the shared planes are merged. Only num_workers slabs are held in
+    memory at once, so memory is O(slab_size * N^2) instead of O(N^3).
+
+    :param decode_fun: (P,3) points on device -> (P,) sdf, (P,C) extra values per point or None (e.g. colors)
+    :return: verts (V,3) in voxel units times voxel_size, as skimage.measure.marching_cubes with spacing;
+             faces (F,3); extra values (V,C) of the grid point each vertex falls in, or None
+    """
+    origin = torch.tensor(voxel_origin, dtype=torch.float32)
+    axis = torch.arange(N)
+
+    def process_slab(first):
+        last = min(first + slab_size, N - 1)
+        idx = torch.stack(torch.meshgrid(torch.arange(first, last + 1), axis, axis, indexing="ij"), dim=-1)
+        idx = idx.reshape(-1, 3)
+        sdf = torch.empty(idx.size(0))
+        extra = None
+        for head in range(0, idx.size(0), max_batch):
+            samples = idx[head : head + max_batch].float() * voxel_size + origin
+            sdf_subset, extra_subset = decode_fun(samples.to(device))
+            sdf[head : head + max_batch] = sdf_subset.reshape(-1).cpu()
+            if extra_subset is not None:
+                if extra is None:
+                    extra = torch.empty(idx.size(0), extra_subset.size(-1))
+                extra[head : head + max_batch] = extra_subset.reshape(-1, extra.size(-1)).cpu()
+        sdf = sdf.reshape(-1, N, N).numpy()
+        if sdf.min() > 0 or sdf.max() < 0:  # the surface does not cross this slab
+            return first, last, None, None, None
+        verts, faces, _, _ = skimage.measure.marching_cubes(sdf, level=0.0, spacing=[voxel_size] * 3)
+        vert_extra = None
+        if extra is not None:
+            # nearest grid point of each vertex, as in convert_sdf_samples_to_ply
+            vert_idx = (verts / voxel_size).astype(int)
+            vert_extra = extra.reshape(-1, N, N, extra.size(-1)).numpy()[vert_idx[:, 0], vert_idx[:, 1], vert_idx[:, 2]]
+        verts[:, 0] += first * voxel_size
+        return first, last, verts, faces, vert_extra
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        verts, faces, extra = _stitch_slabs(pool.map(process_slab, range(0, N - 1, slab_size)), voxel_size)
+    logger.info("slabs: %d vertices, %d faces" % (len(verts), len(faces)))
+    return verts, faces, extra
+
+
+def marching_cubes_blocks(sdf_values, voxel_size, level=0.0, block_size=64, num_workers=None):
+    """
+    skimage.measure.marching_cubes over an (N,N,N) sdf grid, in blocks of block_size cells along the first axis run
+    on num_workers processes (all cores by default)
+
+    The blocks overlap by one plane of grid points and the vertices on the shared planes are merged, so the result
+    has the same vertices and faces as one marching_cubes call over the whole grid, up to their order.
+
+    :return: verts (V,3) in voxel units times voxel_size, faces (F,3)
+    """
+    if isinstance(sdf_values, torch.Tensor):
+        sdf_values = sdf_values.numpy()
+    num_workers = num_workers or os.cpu_count()
+    N = sdf_values.shape[0]
+    blocks = [
+        (first, min(first + block_size, N - 1), sdf_values[first : first + block_size + 1], level, voxel_size)
+        for first in range(0, N - 1, block_size)
+    ]
+    if num_workers == 1 or len(blocks) == 1:
+        verts, faces, _ = _stitch_slabs(map(_marching_cubes_block, blocks), voxel_size)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            verts, faces, _ = _stitch_slabs(pool.map(_marching_cubes_block, blocks), voxel_size)
+    logger.info("blocks: %d vertices, %d faces" % (len(verts), len(faces)))
+    return verts, faces
+
+
+def _marching_cubes_block(args):
+    first, last, sdf, level, voxel_size = args
+    if sdf.min() > level or sdf.max() < level:
+        return first, last, None, None, None
+    verts, faces, _, _ = skimage.measure.marching_cubes(sdf, level=level, spacing=[voxel_size] * 3)
+    verts[:, 0] += first * voxel_size
+    return first, last, verts, faces, None
+
+
+def _stitch_slabs(slabs, voxel_size):
+    """
+    Merge the meshes of consecutive slabs along the first axis into one
+
+    :param slabs: iterable of (first, last, verts, faces, extra), in order, where first and last are the grid planes
+                  the slab spans and verts is None for a slab the surface does not cross
+    """
+    all_verts, all_faces, all_extra = [], [], []
+    num_verts = 0
+    boundary = {}  # (y, z) -> vertex index, for the vertices on the plane shared with the next slab
+    for first, last, verts, faces, vert_extra in slabs:
+        next_boundary = {}
+        if verts is not None:
+            on_first = np.isclose(verts[:, 0], first * voxel_size, rtol=0.0, atol=1e-6 * voxel_size)
+            on_last = np.isclose(verts[:, 0], last * voxel_size, rtol=0.0, atol=1e-6 * voxel_size)
+            # global index of every slab vertex, reusing the previous slab's vertex on the shared plane
+            remap = np.empty(len(verts), dtype=np.int64)
+            new = np.ones(len(verts), dtype=bool)
+            for i in np.nonzero(on_first)[0]:
+                shared = boundary.get((verts[i, 1], verts[i, 2]))
+                if shared is not None:
+                    remap[i] = shared
+                    new[i] = False
+            remap[new] = num_verts + np.arange(new.sum())
+            num_verts += int(new.sum())
+            all_verts.append(verts[new])
+            all_faces.append(remap[faces])
+            if vert_extra is not None:
+                all_extra.append(vert_extra[new])
+            for i in np.nonzero(on_last)[0]:
+                next_boundary[(verts[i, 1], verts[i, 2])] = remap[i]
+        boundary = next_boundary
+
+    if num_verts == 0:
+        raise ValueError("Surface level must be within volume data range.")
+    verts = np.concatenate(all_verts, axis=0)
+    faces = np.concatenate(all_faces, axis=0)
+    extra = np.concatenate(all_extra, axis=0) if len(all_extra) > 0 else None
+    return verts, faces, extra
@@ -38,3 +38,18 @@ def decode_colorsdf2(deepsdf, colorsdf, shape_code, color_code, queries):
     color3d = colorsdf(inputs2)
     color3d = color3d[:, [2, 1, 0]]
     return sdf, color3d
+
+
+def grid_queries(N, voxel_origin, voxel_size, max_batch=32 ** 3, device=device):
+    """
+    Coordinates of the N^3 grid of create_mesh, max_batch points at a time, in x-major order
+
+    Each batch is computed from its flat indices on device, so no N^3 buffer is allocated.
+
+    :return: generator of (head, (P,3) points), where head is the flat index of the first point
+    """
+    origin = torch.tensor(voxel_origin, dtype=torch.float32, device=device)
+    for head in range(0, N ** 3, max_batch):
+        index = torch.arange(head, min(head + max_batch, N ** 3), device=device)
+        grid_index = torch.stack([index // (N * N), (index // N) % N, index % N], dim=1)
+        yield head, grid_index.float() * voxel_size + origin
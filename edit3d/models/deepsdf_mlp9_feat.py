@@ -4,6 +4,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _linear_weight(layer):
+    # nn.utils.weight_norm keeps weight = g * v / ||v|| and only recomputes it in forward
+    if hasattr(layer, "weight_v"):
+        return layer.weight_v * (layer.weight_g / torch.norm(layer.weight_v, dim=1, keepdim=True))
+    return layer.weight
+
+
 class Decoder(nn.Module):
     # shape decoder
     def __init__(self, cfg):
@@ -88,9 +95,35 @@ class Decoder(nn.Module):
         in1 = z
         out1 = self.net1(in1)
         in2 = torch.cat([out1, in1], dim=-1)
+        out2_1 = self.net2_1(in2)
+        return self._forward_from(out2_1)
+
+    # Latent-dependent part of the two layers that see the raw input [z, p]: net1[0] and the skip
+    # connection into net2_1[0]. Computed once per latent, so the query points only pay for the xyz columns.
+    # z: [B D] -> ([B feat_ch], [B feat_ch])
+    def project_latent(self, z):
+        lin1, lin2 = self.net1[0], self.net2_1[0]
+        dim = z.size(-1)
+        skip = lin2.in_features - lin1.in_features
+        proj1 = F.linear(z, _linear_weight(lin1)[:, :dim], lin1.bias)
+        proj2 = F.linear(z, _linear_weight(lin2)[:, skip : skip + dim], lin2.bias)
+        return proj1, proj2
+
+    # Same as forward(cat([z, p])) given the latent projections of every point
+    # proj1, proj2: [N feat_ch] from project_latent, p: [N 3]
+    def forward_projected(self, proj1, proj2, p):
+        lin1, lin2 = self.net1[0], self.net2_1[0]
+        w1, w2 = _linear_weight(lin1), _linear_weight(lin2)
+        dim = w1.size(1) - p.size(-1)
+        skip = lin2.in_features - lin1.in_features
+        out1 = self.net1[1:](proj1 + F.linear(p, w1[:, dim:]))
+        in2 = proj2 + F.linear(out1, w2[:, :skip]) + F.linear(p, w2[:, skip + dim :])
+        out2_1 = self.net2_1[1:](in2)
+        return self._forward_from(out2_1)
+
+    def _forward_from(self, out2_1):
         feat_layer = self.feat_layer
 
-        out2_1 = self.net2_1(in2)
         out2_2 = self.net2_2(out2_1)
         out2_3 = self.net2_3(out2_2)
         out2_4 = self.net2_4(out2_3)
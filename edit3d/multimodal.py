@@ -2,10 +2,14 @@ import os
 
 import logging
 
+from edit3d.loaders.DataManifest import DataManifest, scan_dir
 from edit3d.loaders.NPYLoaderN import NPYLoaderN
+from edit3d.loaders.ShardLoaderN import ShardLoaderN
 from edit3d.samplers.SequentialWarpSampler import SequentialWarpSampler
+from edit3d.samplers.SlotBatchSampler import SlotBatchSampler
 from edit3d.samplers.ShuffleWarpSampler import ShuffleWarpSampler
 from edit3d.utils.PinMemDict import PinMemDict
+from edit3d.utils.StagingRing import StagedBatch, StagingRing
 
 os.environ["OMP_NUM_THREADS"] = "1"
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
@@ -33,6 +37,10 @@ def np_collate(batch):
 
 
 def np_collate_dict(batch):
+    if isinstance(batch, StagedBatch):  # already collated into a StagingRing by the __getitems__ of the dataset
+        return batch
+    if isinstance(batch, dict):  # already collated by the __getitems__ of the dataset
+        return PinMemDict(batch)
     b_out = {}
     for k in batch[0].keys():
         try:
@@ -51,7 +59,8 @@ def np_collate_dict(batch):
     return PinMemDict(b_out)
 
 
-def get_data_loaders(args):
+def get_data_lists(args):
+    """(shape_id, surface, sphere, sketch, color2d) files of the train and test splits"""
     # Load split file
     with open(args.split_files.train) as split_data:
         sp = json.load(split_data)
@@ -61,113 +70,157 @@ def get_data_loaders(args):
         sp = json.load(split_data)
         test_split = set(sp["ShapeNetV2"][args.cate_id])
 
+    # manifest_dir: where the scans of the sdf_data_dir dirs are kept, see DataManifest
+    data_dirs = {kind: getattr(args.sdf_data_dir, kind) for kind in ("sphere", "sketch", "color", "surface")}
+    manifest_dir = getattr(args, "manifest_dir", None)
+    if manifest_dir is not None:
+        entries = DataManifest(manifest_dir, data_dirs).entries()
+    else:
+        entries = {kind: scan_dir(path) for kind, path in data_dirs.items()}
+
     train_data_list = []
     test_data_list = []
     sphere_list = set()
-    with os.scandir(args.sdf_data_dir.sphere) as npy_list:
-        for npy_path in npy_list:
-            if npy_path.is_file():
-                sphere_list.add(npy_path.name.split(".")[0])
+    for npy_name, (is_file, _, _) in entries["sphere"].items():
+        if is_file:
+            sphere_list.add(npy_name.split(".")[0])
 
     # load image data
     im_path = {}
-    with os.scandir(args.sdf_data_dir.sketch) as im_list:
-        for im_name in im_list:
-            if im_name.name in sphere_list:
-                # im_path[im_name.name] = os.path.join(args.sdf_data_dir.sketch, im_name.name, "sketch-F-2.png")
-                im_path[im_name.name] = os.path.join(args.sdf_data_dir.sketch, im_name.name, f"{im_name.name}_000.png")
-                if hasattr(args, "sketch_name"):
-                    im_path[im_name.name] = os.path.join(args.sdf_data_dir.sketch, im_name.name, args.sketch_name)
-
+    for im_name in entries["sketch"]:
+        if im_name in sphere_list:
+            # im_path[im_name] = os.path.join(args.sdf_data_dir.sketch, im_name, "sketch-F-2.png")
+            im_path[im_name] = os.path.join(args.sdf_data_dir.sketch, im_name, f"{im_name}_000.png")
+            if hasattr(args, "sketch_name"):
+                im_path[im_name] = os.path.join(args.sdf_data_dir.sketch, im_name, args.sketch_name)
 
     # load color data
     color2d_path = {}
-    with os.scandir(args.sdf_data_dir.color) as im_list:
-        for im_name in im_list:
-            if im_name.name in sphere_list:
-                color2d_path[im_name.name] = os.path.join(args.sdf_data_dir.sketch, im_name.name, f"{im_name.name}_000.png")
-
-    with os.scandir(args.sdf_data_dir.surface) as npy_list:
-        for npy_path in npy_list:
-            if npy_path.is_file():
-                shape_id = npy_path.name.split(".")[0]
-                if (shape_id in sphere_list) and (shape_id in color2d_path.keys()) and (shape_id in im_path.keys()):
-                    surface_path = npy_path.path
-                    sphere_path = os.path.join(args.sdf_data_dir.sphere, npy_path.name)
-                    if shape_id in train_split:
-                        train_data_list.append(
-                            (
-                                shape_id,
-                                surface_path,
-                                sphere_path,
-                                im_path[shape_id],
-                                color2d_path[shape_id],
-                            )
+    for im_name in entries["color"]:
+        if im_name in sphere_list:
+            color2d_path[im_name] = os.path.join(args.sdf_data_dir.sketch, im_name, f"{im_name}_000.png")
+
+    for npy_name, (is_file, _, _) in entries["surface"].items():
+        if is_file:
+            shape_id = npy_name.split(".")[0]
+            if (shape_id in sphere_list) and (shape_id in color2d_path.keys()) and (shape_id in im_path.keys()):
+                surface_path = os.path.join(args.sdf_data_dir.surface, npy_name)
+                sphere_path = os.path.join(args.sdf_data_dir.sphere, npy_name)
+                if shape_id in train_split:
+                    train_data_list.append(
+                        (
+                            shape_id,
+                            surface_path,
+                            sphere_path,
+                            im_path[shape_id],
+                            color2d_path[shape_id],
                         )
-                    if shape_id in test_split:
-                        test_data_list.append(
-                            (
-                                shape_id,
-                                surface_path,
-                                sphere_path,
-                                im_path[shape_id],
-                                color2d_path[shape_id],
-                            )
+                    )
+                if shape_id in test_split:
+                    test_data_list.append(
+                        (
+                            shape_id,
+                            surface_path,
+                            sphere_path,
+                            im_path[shape_id],
+                            color2d_path[shape_id],
                         )
-                else:
-                    logger.error(f"ERROR! {shape_id} not found in coarse SDFs.")
+                    )
+            else:
+                logger.error(f"ERROR! {shape_id} not found in coarse SDFs.")
 
     train_data_list.sort()
     test_data_list.sort()
-    logger.info("[get_data_loaders] #train: %s; #test: %s.", len(train_data_list), len(test_data_list))
+    return train_data_list, test_data_list
+
+
+def get_batch_kwargs(args, dataset, sampler, split_args):
+    """The batching arguments of the DataLoader of a split, collating into a StagingRing if args.staging_ring"""
+    if not getattr(args, "staging_ring", False) or len(dataset) == 0:
+        return {"batch_size": split_args.batch_size, "sampler": sampler, "shuffle": False, "drop_last": False}
+    # the batches in flight, 2 per worker by default, and the batches the trainer may still be copying from
+    num_slots = getattr(args, "staging_slots", 2 * split_args.num_workers + 3)
+    dataset.staging = StagingRing(num_slots, dataset.staging_shapes(split_args.batch_size))
+    batch_sampler = torch.utils.data.BatchSampler(sampler, split_args.batch_size, drop_last=False)
+    return {"batch_sampler": SlotBatchSampler(batch_sampler, num_slots)}
+
+
+def get_data_loaders(args):
+    # shard_dir: the train and test splits packed by edit3d.toolbox.pack_shards, read instead of the sdf_data_dir files
+    # image_cache_dir: otherwise, where the decoded and resized images of the sdf_data_dir files are kept
+    shard_dir = getattr(args, "shard_dir", None)
+    if shard_dir is not None:
+        train_dataset = ShardLoaderN(
+            os.path.join(shard_dir, "train"),
+            args.train.num_sample_points.fine,
+            args.train.num_sample_points.coarse,
+            imsize=args.train.imsize,
+        )
+        test_split = "test"
+        if getattr(args.test, "test_on_train_set", False):
+            test_split = "train"
+            logger.info("[NewSDF Dataset] Testing on train set...")
+        test_dataset = ShardLoaderN(
+            os.path.join(shard_dir, test_split),
+            args.test.num_sample_points.fine,
+            args.test.num_sample_points.coarse,
+            imsize=args.test.imsize,
+            subset=getattr(args.test, "subset", None),
+        )
+        train_shape_ids = train_dataset.shape_ids
+        test_shape_ids = test_dataset.shape_ids
+        logger.info("[get_data_loaders] #train: %s; #test: %s.", len(train_shape_ids), len(test_shape_ids))
+    else:
+        train_data_list, test_data_list = get_data_lists(args)
+        logger.info("[get_data_loaders] #train: %s; #test: %s.", len(train_data_list), len(test_data_list))
+
+        train_dataset = NPYLoaderN(
+            train_data_list,
+            args.train.num_sample_points.fine,
+            args.train.num_sample_points.coarse,
+            imsize=args.train.imsize,
+            image_cache_dir=getattr(args, "image_cache_dir", None),
+            image_cache_workers=getattr(args, "image_cache_workers", None),
+        )
+
+        if getattr(args.test, "test_on_train_set", False):
+            test_data_list = train_data_list
+            logger.info("[NewSDF Dataset] Testing on train set...")
+        if getattr(args.test, "subset", None):
+            test_data_list = test_data_list[: args.test.subset]
+            logger.info("[get_data_loaders] Subsetting test set to {}".format(args.test.subset))
+        test_dataset = NPYLoaderN(
+            test_data_list,
+            args.test.num_sample_points.fine,
+            args.test.num_sample_points.coarse,
+            imsize=args.test.imsize,
+            image_cache_dir=getattr(args, "image_cache_dir", None),
+            image_cache_workers=getattr(args, "image_cache_workers", None),
+        )
+
+        train_shape_ids = [x[0] for x in train_data_list]
+        test_shape_ids = [x[0] for x in test_data_list]
 
-    train_dataset = NPYLoaderN(
-        train_data_list,
-        args.train.num_sample_points.fine,
-        args.train.num_sample_points.coarse,
-        imsize=args.train.imsize,
-    )
     train_sampler = ShuffleWarpSampler(train_dataset, n_repeats=args.train.num_repeats)
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=args.train.batch_size,
-        sampler=train_sampler,
-        shuffle=False,
+        **get_batch_kwargs(args, train_dataset, train_sampler, args.train),
         num_workers=args.train.num_workers,
         pin_memory=True,
-        drop_last=False,
         collate_fn=np_collate_dict,
         worker_init_fn=init_np_seed,
     )
 
-    if getattr(args.test, "test_on_train_set", False):
-        test_data_list = train_data_list
-        logger.info("[NewSDF Dataset] Testing on train set...")
-    if getattr(args.test, "subset", None):
-        test_data_list = test_data_list[: args.test.subset]
-        logger.info("[get_data_loaders] Subsetting test set to {}".format(args.test.subset))
-    test_dataset = NPYLoaderN(
-        test_data_list,
-        args.test.num_sample_points.fine,
-        args.test.num_sample_points.coarse,
-        imsize=args.test.imsize,
-    )
     test_sampler = SequentialWarpSampler(test_dataset, n_repeats=args.test.num_repeats)
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
-        batch_size=args.test.batch_size,
-        sampler=test_sampler,
-        shuffle=False,
+        **get_batch_kwargs(args, test_dataset, test_sampler, args.test),
         num_workers=args.test.num_workers,
         pin_memory=True,
-        drop_last=False,
         collate_fn=np_collate_dict,
         worker_init_fn=init_np_seed,
     )
 
-    train_shape_ids = [x[0] for x in train_data_list]
-    test_shape_ids = [x[0] for x in test_data_list]
-
     loaders = {
         "train_loader": train_loader,
         "train_shape_ids": train_shape_ids,
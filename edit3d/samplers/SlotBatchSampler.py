@@ -0,0 +1,35 @@
+import logging
+from torch.utils.data import Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+class SlotIndices(list):
+    """The indices of a batch and the slot of the StagingRing to collate it into"""
+
+    def __init__(self, indices, slot):
+        super().__init__(indices)
+        self.slot = slot
+
+
+class SlotBatchSampler(Sampler):
+    """
+    Batches of batch_sampler tagged with slot n % num_slots for batch n
+
+    DataLoader hands out batches in order and dispatches batch n once batch n - num_workers * prefetch_factor is
+    consumed, so a slot is written again only num_slots batches after it was consumed. The count goes on across epochs.
+    """
+
+    def __init__(self, batch_sampler, num_slots):
+        self.batch_sampler = batch_sampler
+        self.num_slots = num_slots
+        self.num_batches = 0
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            yield SlotIndices(indices, self.num_batches % self.num_slots)
+            self.num_batches += 1
+
+    def __len__(self):
+        return len(self.batch_sampler)
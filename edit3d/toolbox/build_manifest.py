@@ -0,0 +1,46 @@
+import argparse
+import logging
+
+import yaml
+
+from edit3d.loaders.DataManifest import DataManifest
+from edit3d.multimodal import get_data_lists
+from edit3d.utils.utils import dict2namespace
+
+logger = logging.getLogger(__name__)
+
+
+def main(args, cfg):
+    if args.manifest_dir is not None:
+        cfg.data.manifest_dir = args.manifest_dir
+    if getattr(cfg.data, "manifest_dir", None) is None:
+        raise ValueError("Set data.manifest_dir in the config or pass --manifest_dir")
+    data_dirs = {kind: getattr(cfg.data.sdf_data_dir, kind) for kind in ("sphere", "sketch", "color", "surface")}
+    manifest = DataManifest(cfg.data.manifest_dir, data_dirs)
+    if args.check:
+        changed = manifest.changed_files()
+        for path in changed:
+            logger.info("Changed: %s", path)
+        logger.info("%d files changed since the manifest %s was built", len(changed), manifest.path)
+        return
+    manifest.rebuild()
+    train_data_list, test_data_list = get_data_lists(cfg.data)
+    logger.info("Wrote %s: #train: %d; #test: %d", manifest.path, len(train_data_list), len(test_data_list))
+
+
+if __name__ == "__main__":
+    # python -m edit3d.toolbox.build_manifest config/chair_train.yaml --manifest_dir datasets/chairs/manifests
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Rebuild the manifest of the sdf_data_dir dirs of a config, read by get_data_lists when "
+        "data.manifest_dir is set."
+    )
+    parser.add_argument("config", type=str, help="The configuration file.")
+    parser.add_argument("--manifest_dir", default=None, type=str, help="overrides data.manifest_dir of the config")
+    parser.add_argument("--check", action="store_true", help="only list the files changed since the last build")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    cfg = dict2namespace(config)
+    main(args, cfg)
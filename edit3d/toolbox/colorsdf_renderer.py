@@ -1,3 +1,6 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 # PyTorch
@@ -6,6 +9,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import edit3d
+from edit3d.toolbox.sphere_tracer import estimate_normals, eval_points, march_active_rays
+
+logger = logging.getLogger(__name__)
 
 
 class SDFRenderer:
@@ -13,6 +19,8 @@ class SDFRenderer:
         self.cfg = cfg
         self.device = device
         self.setup_camera()
+        self.last_steps = 0  # march steps used by the last render
+        self.last_travel = None  # [N H W 1] ray travel to the surface in the last render, nan for background
         self.colorize = colorize
 
     # ray_dir: N H W 3
@@ -62,21 +70,30 @@ class SDFRenderer:
     # input: [N H W 3] wavefront position
     # output: [N H W 1] distances
     # output: [N H W 1] primitive index
-    def scene_fun(self, sdf_fun, ray_pos):
+    # batch_idx: [N*H*W] latent index of each position, when sdf_fun renders several latents at once
+    # output: [N H W 3] surface color, None if sdf_fun only returns distances
+    def scene_fun(self, sdf_fun, ray_pos, batch_idx=None):
         net_input = ray_pos.reshape(-1, 3)
-        net_output = sdf_fun(net_input)
+        net_output = eval_points(sdf_fun, net_input, batch_idx)
         dists = net_output["dists"]
-        color3d = net_output["color3d"]
+        color3d = net_output.get("color3d")
         if "indices" in net_output.keys():
             idx = net_output["indices"]
             idx = idx.reshape(ray_pos.size(0), ray_pos.size(1), ray_pos.size(2), 1)
         else:
             idx = None
         march_dist = dists.reshape(ray_pos.size(0), ray_pos.size(1), ray_pos.size(2), 1)
-        color3d = color3d.reshape(ray_pos.size(0), ray_pos.size(1), ray_pos.size(2), 3)
+        if color3d is not None:
+            color3d = color3d.reshape(ray_pos.size(0), ray_pos.size(1), ray_pos.size(2), 3)
         return march_dist, idx, color3d  # [1, 512, 768, 1]
 
     def setup_camera(self):
+        camera = self.build_camera(self.cfg.rot_hor_deg, self.cfg.rot_ver_deg)
+        self.ray_dir_w, self.ray_ori_w, self.ray_travel, self.ray_travel_far, self.bg_mask = camera
+
+    # Camera rays of one view
+    # output: [1 H W 3] ray_dir_w, ray_ori_w; [1 H W 1] ray_travel, ray_travel_far, bg_mask
+    def build_camera(self, rot_hor_deg, rot_ver_deg):
         target_res = self.cfg.resolution  # w h
         ver_scale = self.cfg.ver_scale
         hor_scale = ver_scale / target_res[1] * target_res[0]
@@ -116,17 +133,26 @@ class SDFRenderer:
         ray_dir_w, ray_ori_w = self.cam_lookat(
             ray_dir,
             ray_ori,
-            self.cfg.rot_ver_deg * np.pi / 180,
-            self.cfg.rot_hor_deg * np.pi / 180,
+            rot_ver_deg * np.pi / 180,
+            rot_hor_deg * np.pi / 180,
         )  # ray_dir, ray_ori, rot_x, rot_y
         # Init ray travel
         ray_travel, ray_travel_far = self.init_rt_sph(ray_dir_w, ray_ori_w, r=self.cfg.bsphere_r)
         bg_mask = torch.isnan(ray_travel)  # [1,target_res[1],target_res[0],1], bg == True
-        self.ray_dir_w = ray_dir_w
-        self.ray_ori_w = ray_ori_w
-        self.ray_travel = ray_travel
-        self.ray_travel_far = ray_travel_far
-        self.bg_mask = bg_mask
+        return ray_dir_w, ray_ori_w, ray_travel, ray_travel_far, bg_mask
+
+    # memory held by the camera buffers
+    def camera_nbytes(self):
+        buffers = [self.ray_dir_w, self.ray_ori_w, self.ray_travel, self.ray_travel_far, self.bg_mask]
+        return sum(b.numel() * b.element_size() for b in buffers)
+
+    # cfg.normal_mode: autograd, tetrahedral or forward, see sphere_tracer.estimate_normals. Defaults to
+    # tetrahedral when cfg.numerical_normal is set, autograd otherwise
+    def normal_mode(self):
+        normal_mode = getattr(self.cfg, "normal_mode", None)
+        if normal_mode is None:
+            normal_mode = "tetrahedral" if self.cfg.numerical_normal else "autograd"
+        return normal_mode.lower()
 
     # cfg:
     # cam_model: Orthographic # Perspective
@@ -136,52 +162,307 @@ class SDFRenderer:
     # sdf_iso_level: 0.004
     # sdf_clamp: 0.1
     # sdf_gain: 1.0
+    # compact_rays: True # march only the rays that have not converged or left the bounding sphere
+    # max_points: 262144 # rays traced per decoder batch, None for the whole frame at once
+    # render_threads: 1 # tiles traced in parallel when max_points is set
+    # sdf_omega, refine_steps, converge_eps: adaptive tracing, see sphere_tracer.march_active_rays
+    # warm_start_margin: 0.05 # back-off from the previous frame's depth in render_sequence
+    # warm_start_radius: 2 # pixels around previous silhouettes that render_sequence traces from scratch
     # colorcoord: 256, [r]xyzrgb, for coloring DeepSDF (radius optional).
     # coloridx: 256, rgb, for coloring spheres and capsules
     # Set them to None for default shading (blue sky, red sun)
-    def render(self, sdf_fun, coloridx=None, colorcoord=None):
+    # color_fun: [M 3] hit points -> [M 3] rgb. If given, sdf_fun only needs to return distances and the
+    # surface color is evaluated once on the final hit points instead of on every march step.
+    def render(self, sdf_fun, coloridx=None, colorcoord=None, color_fun=None, occupancy=None):
+        return self.render_batch(
+            sdf_fun, 1, coloridx=coloridx, colorcoord=colorcoord, color_fun=color_fun, occupancy=occupancy
+        )[0]
+
+    # Render num_latents images in one pass over the [N H W 3] wavefront.
+    # sdf_fun(p, batch_idx) and color_fun(p, batch_idx) get the latent index of every point when N > 1.
+    # output: [N H W 3] uint8
+    def render_batch(self, sdf_fun, num_latents, coloridx=None, colorcoord=None, color_fun=None, occupancy=None):
+        N = num_latents
+        batch_idx = None
+        if N > 1:
+            batch_idx = torch.arange(N, device=self.device).repeat_interleave(self.bg_mask.numel())
+        return self.render_rays(
+            sdf_fun,
+            self.ray_dir_w.expand(N, -1, -1, -1),
+            self.ray_ori_w.expand(N, -1, -1, -1),
+            self.ray_travel.expand(N, -1, -1, -1),
+            self.ray_travel_far.expand(N, -1, -1, -1),
+            self.bg_mask.expand(N, -1, -1, -1),
+            batch_idx=batch_idx,
+            coloridx=coloridx,
+            colorcoord=colorcoord,
+            color_fun=color_fun,
+            occupancy=occupancy,
+        )
+
+    # Render one latent from several camera poses in one pass, e.g. for turntables.
+    # poses: list of (rot_hor_deg, rot_ver_deg)
+    # output: [V H W 3] uint8
+    def render_views(self, sdf_fun, poses, coloridx=None, colorcoord=None, color_fun=None, occupancy=None):
+        cameras = [self.build_camera(rot_hor_deg, rot_ver_deg) for rot_hor_deg, rot_ver_deg in poses]
+        ray_dir_w, ray_ori_w, ray_travel, ray_travel_far, bg_mask = [torch.cat(b, dim=0) for b in zip(*cameras)]
+        return self.render_rays(
+            sdf_fun,
+            ray_dir_w,
+            ray_ori_w,
+            ray_travel,
+            ray_travel_far,
+            bg_mask,
+            coloridx=coloridx,
+            colorcoord=colorcoord,
+            color_fun=color_fun,
+            occupancy=occupancy,
+        )
+
+    # Render a sequence of slowly changing shapes, e.g. the snapshots of an edit, one frame per sdf_fun.
+    # After the first frame, rays start at the previous frame's depth minus cfg.warm_start_margin, see warm_start.
+    # color_funs, occupancies: one per frame, or None
+    # output: generator of [H W 3] uint8
+    def render_sequence(self, sdf_funs, coloridx=None, colorcoord=None, color_funs=None, occupancies=None):
+        prev_travel = None
+        for i, sdf_fun in enumerate(sdf_funs):
+            ray_travel = self.ray_travel if prev_travel is None else self.warm_start(sdf_fun, prev_travel)
+            img = self.render_rays(
+                sdf_fun,
+                self.ray_dir_w,
+                self.ray_ori_w,
+                ray_travel,
+                self.ray_travel_far,
+                self.bg_mask,
+                coloridx=coloridx,
+                colorcoord=colorcoord,
+                color_fun=None if color_funs is None else color_funs[i],
+                occupancy=None if occupancies is None else occupancies[i],
+            )
+            prev_travel = self.last_travel
+            yield img[0]
+
+    # Initial ray travel from the depth of a previous frame of the same camera, [1 H W 1], nan for background.
+    # Rays that hit the previous surface start cfg.warm_start_margin in front of it, unless the SDF is negative
+    # there: the surface moved closer than the margin and the ray is traced from the bounding sphere again,
+    # like the rays that missed the previous frame. So are the rays within cfg.warm_start_radius pixels of a
+    # silhouette or depth discontinuity of the previous frame, where a moving occluder may slide in front of the seed.
+    def warm_start(self, sdf_fun, prev_travel):
+        margin = getattr(self.cfg, "warm_start_margin", 0.05)
+        radius = getattr(self.cfg, "warm_start_radius", 2)
+        ray_travel = self.ray_travel.clone()
+        depth = prev_travel.permute(0, 3, 1, 2)  # [1 1 H W]
+        miss = torch.isnan(depth)
+        depth = depth.masked_fill(miss, 0.0)
+        window = dict(kernel_size=2 * radius + 1, stride=1, padding=radius)
+        near_miss = F.max_pool2d(miss.float(), **window) > 0
+        depth_range = F.max_pool2d(depth, **window) + F.max_pool2d(-depth, **window)
+        unsafe = (near_miss | (depth_range > margin)).permute(0, 2, 3, 1)
+        seeded = (~unsafe & ~self.bg_mask).reshape(-1)
+        ray_idx = torch.nonzero(seeded, as_tuple=False).squeeze(-1)
+        if ray_idx.numel() == 0:
+            return ray_travel
+        ray_travel = ray_travel.reshape(-1, 1)
+        ray_ori = self.ray_ori_w.expand_as(self.ray_dir_w).reshape(-1, 3)
+        ray_dir = self.ray_dir_w.reshape(-1, 3)
+        seed = torch.max(prev_travel.reshape(-1, 1) - margin, ray_travel)
+        max_points = getattr(self.cfg, "max_points", None) or ray_idx.numel()
         with torch.no_grad():
-            ray_travel = self.ray_travel
-            ray_travel_far = self.ray_travel_far
-            bg_mask = self.bg_mask
-            ray_dir_w = self.ray_dir_w
-            ray_ori_w = self.ray_ori_w
+            for chunk in torch.split(ray_idx, max_points):
+                dists = sdf_fun(ray_ori[chunk] + seed[chunk] * ray_dir[chunk])["dists"].reshape(-1, 1)
+                outside = dists - self.cfg.sdf_iso_level > 0
+                ray_travel[chunk] = torch.where(outside, seed[chunk], ray_travel[chunk])
+        return ray_travel.reshape(self.ray_travel.shape)
+
+    # Trace and shade a [N H W 3] wavefront
+    # batch_idx: [N*H*W] latent index of each ray, None if all rays see the same latent
+    # occupancy: OccupancyGrid of the rendered latent(s), None to march from the bounding sphere
+    # cfg.max_points bounds the number of rays traced together, see shade_tiles
+    def render_rays(
+        self,
+        sdf_fun,
+        ray_dir_w,
+        ray_ori_w,
+        ray_travel,
+        ray_travel_far,
+        bg_mask,
+        batch_idx=None,
+        coloridx=None,
+        colorcoord=None,
+        color_fun=None,
+        occupancy=None,
+    ):
+        self.frame_steps = []  # march steps of every shaded wavefront (tile)
+        if occupancy is not None:
+            # empty space skipping: rays start at their first occupied cell, or miss the shape altogether
+            ray_travel, ray_travel_far, hit = occupancy.clip_rays(
+                ray_ori_w.expand_as(ray_dir_w).reshape(-1, 3),
+                ray_dir_w.reshape(-1, 3),
+                ray_travel.reshape(-1, 1),
+                ray_travel_far.reshape(-1, 1),
+                ~bg_mask.reshape(-1),
+                batch_idx=batch_idx,
+            )
+            ray_travel = ray_travel.reshape(bg_mask.shape)
+            ray_travel_far = ray_travel_far.reshape(bg_mask.shape)
+            bg_mask = bg_mask | ~hit.reshape(bg_mask.shape)
+        max_points = getattr(self.cfg, "max_points", None)
+        shade = self.shade_rays if max_points is None or bg_mask.numel() <= max_points else self.shade_tiles
+        framebuffer, self.last_travel = shade(
+            sdf_fun,
+            ray_dir_w,
+            ray_ori_w,
+            ray_travel,
+            ray_travel_far,
+            bg_mask,
+            batch_idx=batch_idx,
+            coloridx=coloridx,
+            colorcoord=colorcoord,
+            color_fun=color_fun,
+        )
+        self.last_steps = max(self.frame_steps, default=0)
+        logger.debug("[{}] traced in {} / {} steps".format(type(self).__name__, self.last_steps, self.cfg.steps))
+        img = (torch.clamp(framebuffer, 0, 1).cpu().numpy() * 255).astype(np.uint8)
+        return img
+
+    # Split the rays entering the bounding sphere into tiles of cfg.max_points rays and shade them one by one,
+    # or cfg.render_threads tiles at a time, so that the decoder batch does not grow with the resolution.
+    # Background rays never reach the decoder.
+    # output: [N H W 3] framebuffer, [N H W 1] ray travel to the surface (nan for background)
+    def shade_tiles(self, sdf_fun, ray_dir_w, ray_ori_w, ray_travel, ray_travel_far, bg_mask, batch_idx=None, **kwargs):
+        # a [T 1 1 C] tile is a valid wavefront for shade_rays
+        ray_dir = ray_dir_w.reshape(-1, 1, 1, 3)
+        ray_ori = ray_ori_w.expand_as(ray_dir_w).reshape(-1, 1, 1, 3)
+        ray_travel = ray_travel.reshape(-1, 1, 1, 1)
+        ray_travel_far = ray_travel_far.reshape(-1, 1, 1, 1)
+        ray_bg_mask = bg_mask.reshape(-1, 1, 1, 1)
+
+        def shade_tile(tile):
+            tile_batch_idx = None if batch_idx is None else batch_idx[tile]
+            return self.shade_rays(
+                sdf_fun,
+                ray_dir[tile],
+                ray_ori[tile],
+                ray_travel[tile],
+                ray_travel_far[tile],
+                ray_bg_mask[tile],
+                batch_idx=tile_batch_idx,
+                **kwargs,
+            )
+
+        bg_color = torch.tensor(self.cfg.bg_color, dtype=torch.float32, device=self.device)
+        framebuffer = bg_color.repeat(bg_mask.numel(), 1)
+        depth = torch.full((bg_mask.numel(), 1), float("nan"), device=self.device)
+        ray_idx = torch.nonzero(~bg_mask.reshape(-1), as_tuple=False).squeeze(-1)
+        tiles = torch.split(ray_idx, self.cfg.max_points)
+        num_threads = getattr(self.cfg, "render_threads", 1)
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                for tile, (tile_framebuffer, tile_depth) in zip(tiles, pool.map(shade_tile, tiles)):
+                    framebuffer[tile] = tile_framebuffer.reshape(-1, 3)
+                    depth[tile] = tile_depth.reshape(-1, 1)
+        else:
+            for tile in tiles:
+                tile_framebuffer, tile_depth = shade_tile(tile)
+                framebuffer[tile] = tile_framebuffer.reshape(-1, 3)
+                depth[tile] = tile_depth.reshape(-1, 1)
+        return framebuffer.reshape(*bg_mask.shape[:3], 3), depth.reshape(bg_mask.shape)
+
+    # Trace and shade a [N H W 3] wavefront in one decoder batch
+    # output: [N H W 3] framebuffer, [N H W 1] ray travel to the surface (nan for background)
+    def shade_rays(
+        self,
+        sdf_fun,
+        ray_dir_w,
+        ray_ori_w,
+        ray_travel,
+        ray_travel_far,
+        bg_mask,
+        batch_idx=None,
+        coloridx=None,
+        colorcoord=None,
+        color_fun=None,
+    ):
+        # no_grad is thread local, shade_rays may run on a shade_tiles worker
+        with torch.no_grad():
+            ray_travel = ray_travel.clone()  # the camera buffers are reused across renders
 
             # Ray marching
-            for march_step in range(self.cfg.steps):
-                print(".", end="", flush=True)
-                ray_pos = ray_ori_w + ray_travel * ray_dir_w
-                march_dist, idx, color3d = self.scene_fun(sdf_fun, ray_pos)  # get signed distance + surface color
-                march_dist -= self.cfg.sdf_iso_level
-                march_dist = torch.clamp(march_dist, -self.cfg.sdf_clamp, self.cfg.sdf_clamp)
-                ray_travel += march_dist * self.cfg.sdf_gain
-                ray_travel = torch.min(ray_travel, ray_travel_far)
-            print("*")
+            normal_mode = self.normal_mode()
+            keep = ("indices",) if coloridx is not None else ()
+            if color_fun is None:
+                keep += ("color3d",)
+            if normal_mode == "forward":
+                keep += ("dists", "travel")
+            if getattr(self.cfg, "compact_rays", False):
+                ray_travel, kept, num_steps = march_active_rays(
+                    sdf_fun,
+                    ray_ori_w.expand_as(ray_dir_w).reshape(-1, 3),
+                    ray_dir_w.reshape(-1, 3),
+                    ray_travel.reshape(-1, 1),
+                    ray_travel_far.reshape(-1, 1),
+                    ~bg_mask.reshape(-1),
+                    self.cfg,
+                    batch_idx=batch_idx,
+                    keep=keep,
+                )
+                ray_travel = ray_travel.reshape(bg_mask.shape)
+                idx = kept.get("indices")
+                if idx is not None:
+                    idx = idx.reshape(bg_mask.shape)
+                march_dists, march_travel = kept.get("dists"), kept.get("travel")
+                color3d = kept.get("color3d")
+                if color3d is not None:
+                    color3d = color3d.reshape(ray_dir_w.shape)
+                elif color_fun is None:  # no ray entered the bounding sphere
+                    color3d = torch.zeros_like(ray_dir_w)
+            else:
+                converge_eps = getattr(self.cfg, "converge_eps", 1e-4)
+                num_steps = 0
+                march_dists = march_travel = None
+                for march_step in range(self.cfg.steps):
+                    print(".", end="", flush=True)
+                    ray_pos = ray_ori_w + ray_travel * ray_dir_w
+                    # get signed distance + surface color
+                    march_dist, idx, color3d = self.scene_fun(sdf_fun, ray_pos, batch_idx)
+                    march_dist -= self.cfg.sdf_iso_level
+                    march_dist = torch.clamp(march_dist, -self.cfg.sdf_clamp, self.cfg.sdf_clamp)
+                    ray_travel += march_dist * self.cfg.sdf_gain
+                    ray_travel = torch.min(ray_travel, ray_travel_far)
+                    # stop once every ray has converged or left the bounding sphere
+                    num_steps = march_step + 1
+                    marching = (torch.abs(march_dist) > converge_eps) & ((ray_travel_far - ray_travel) >= 1e-5)
+                    if not marching.any():
+                        break
+                print("*")
+            self.frame_steps.append(num_steps)
             bg_mask = bg_mask | ((ray_travel_far - ray_travel) < 1e-5)
 
             ray_pos = ray_ori_w + ray_travel * ray_dir_w  # color is stored in color3d
-            if self.cfg.numerical_normal:
-                # https://iquilezles.org/www/articles/normalsSDF/normalsSDF.htm
-                eps = 5e-4
-                k1 = torch.tensor([1, -1, -1], dtype=torch.float32, device=self.device)
-                k2 = torch.tensor([-1, -1, 1], dtype=torch.float32, device=self.device)
-                k3 = torch.tensor([-1, 1, -1], dtype=torch.float32, device=self.device)
-                k4 = torch.tensor([1, 1, 1], dtype=torch.float32, device=self.device)
-                normals = F.normalize(
-                    k1 * self.scene_fun(sdf_fun, ray_pos + eps * k1)[0]
-                    + k2 * self.scene_fun(sdf_fun, ray_pos + eps * k2)[0]
-                    + k3 * self.scene_fun(sdf_fun, ray_pos + eps * k3)[0]
-                    + k4 * self.scene_fun(sdf_fun, ray_pos + eps * k4)[0],
-                    dim=-1,
+            hit_mask = ~bg_mask[..., 0]
+            if self.colorize and color_fun is not None:
+                # Appearance pass: one color decoder call over the surface hit points
+                color3d = torch.zeros_like(ray_pos)
+                if hit_mask.any():
+                    hit_batch_idx = None if batch_idx is None else batch_idx[hit_mask.reshape(-1)]
+                    color3d[hit_mask] = eval_points(color_fun, ray_pos[hit_mask], hit_batch_idx).reshape(-1, 3)
+            # Surface normals, on the hit pixels only
+            normals = torch.zeros_like(ray_pos)
+            if hit_mask.any():
+                hit_batch_idx = None if batch_idx is None else batch_idx[hit_mask.reshape(-1)]
+                normal_pos, normal_dists = ray_pos[hit_mask], None
+                if march_dists is not None:
+                    # forward differences around the last march evaluation, whose SDF is already known
+                    normal_pos = (ray_ori_w + march_travel.reshape(bg_mask.shape) * ray_dir_w)[hit_mask]
+                    normal_dists = march_dists.reshape(bg_mask.shape)[hit_mask]
+                normals[hit_mask] = estimate_normals(
+                    sdf_fun,
+                    normal_pos,
+                    normal_mode,
+                    batch_idx=hit_batch_idx,
+                    dists=normal_dists,
+                    eps=getattr(self.cfg, "normal_eps", 5e-4),
                 )
-            else:
-                # Autograd surface normal
-                with torch.enable_grad():
-                    ray_pos.requires_grad = True
-                    dd = self.scene_fun(sdf_fun, ray_pos)[0]
-                    dd.backward(torch.ones_like(dd) + dd * 0.0, retain_graph=True)
-                    normals = F.normalize(ray_pos.grad, dim=-1)
-                    ray_pos.requires_grad = False
 
             # Shading
             # Assuming lambertian surface
@@ -221,6 +502,6 @@ class SDFRenderer:
             framebuffer = (framebuffer) ** (1 / 2.2)
 
             framebuffer[bg_mask[..., 0], :] = torch.tensor(self.cfg.bg_color, dtype=torch.float32, device=self.device)
-            img = (torch.clamp(framebuffer, 0, 1)[0].cpu().numpy() * 255).astype(np.uint8)
+            depth = ray_travel.masked_fill(bg_mask, float("nan"))
 
-        return img
+        return framebuffer, depth
@@ -0,0 +1,85 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from edit3d.toolbox.sphere_tracer import eval_points
+
+
+class OccupancyGrid:
+    """Coarse occupancy of the cube [-bound, bound]^3 around one or more latents, for empty space skipping.
+
+    A cell is occupied when the iso-surface may cross it, i.e. the SDF at its center is within half a cell
+    diagonal of the iso-level, dilated by one cell since the decoders are not exact distance functions.
+    occupied: [N R R R] bool, one grid per latent, indexed x, y, z
+    """
+
+    def __init__(self, occupied, bound):
+        self.occupied = occupied
+        self.bound = bound
+        self.resolution = occupied.size(-1)
+        self.cell_size = 2.0 * bound / self.resolution
+
+    # sdf_fun(p[, batch_idx]) as given to the renderers, num_latents grids are built in one decoder pass
+    @classmethod
+    @torch.no_grad()
+    def from_sdf(cls, sdf_fun, bound, resolution=32, iso_level=0.0, num_latents=1, device=None):
+        cell_size = 2.0 * bound / resolution
+        centers = (torch.arange(resolution, dtype=torch.float32, device=device) + 0.5) * cell_size - bound
+        p = torch.stack(torch.meshgrid(centers, centers, centers, indexing="ij"), dim=-1).reshape(-1, 3)
+        batch_idx = None
+        if num_latents > 1:
+            batch_idx = torch.arange(num_latents, device=device).repeat_interleave(p.size(0))
+            p = p.repeat(num_latents, 1)
+        dists = eval_points(sdf_fun, p, batch_idx)["dists"].reshape(num_latents, 1, resolution, resolution, resolution)
+        occupied = (torch.abs(dists - iso_level) <= cell_size * math.sqrt(3) / 2).float()
+        occupied = F.max_pool3d(occupied, kernel_size=3, stride=1, padding=1)
+        return cls(occupied.squeeze(1) > 0, bound)
+
+    # Stack the grids of several latents, in batch_idx order
+    @classmethod
+    def cat(cls, grids):
+        return cls(torch.cat([grid.occupied for grid in grids], dim=0), grids[0].bound)
+
+    # p: [R 3], batch_idx: [R] or None
+    # output: [R] bool
+    def lookup(self, p, batch_idx=None):
+        cell = torch.floor((p + self.bound) / self.cell_size).long()
+        inside = ((cell >= 0) & (cell < self.resolution)).all(dim=-1)
+        cell = cell.clamp(0, self.resolution - 1)
+        flat = (cell[:, 0] * self.resolution + cell[:, 1]) * self.resolution + cell[:, 2]
+        if batch_idx is None:
+            batch_idx = torch.zeros_like(flat)
+        return self.occupied.reshape(self.occupied.size(0), -1)[batch_idx, flat] & inside
+
+    # Tighten the [ray_travel, ray_travel_far] interval of each ray to the occupied cells it crosses, sampling
+    # every half cell. Rays that cross no occupied cell get ray_travel = ray_travel_far.
+    # ray_ori, ray_dir: [R 3]; ray_travel, ray_travel_far: [R 1]; active: [R] bool
+    # output: [R 1] ray_travel, ray_travel_far; [R] bool hit
+    def clip_rays(self, ray_ori, ray_dir, ray_travel, ray_travel_far, active, batch_idx=None):
+        ray_travel = ray_travel.clone()
+        ray_travel_far = ray_travel_far.clone()
+        hit = torch.zeros_like(active)
+        ray_idx = torch.nonzero(active, as_tuple=False).squeeze(-1)
+        if ray_idx.numel() == 0:
+            return ray_travel, ray_travel_far, hit
+
+        ori, direction = ray_ori[ray_idx], ray_dir[ray_idx]
+        near, far = ray_travel[ray_idx], ray_travel_far[ray_idx]
+        ray_batch_idx = None if batch_idx is None else batch_idx[ray_idx]
+        step = self.cell_size / 2
+        first = torch.full_like(near, float("inf"))
+        last = torch.full_like(near, -float("inf"))
+        num_samples = int(math.ceil((far - near).max().item() / step)) + 1
+        for k in range(num_samples):
+            t = near + k * step
+            occupied = self.lookup(ori + t * direction, ray_batch_idx).unsqueeze(-1) & (t <= far)
+            first = torch.where(occupied & torch.isinf(first), t, first)
+            last = torch.where(occupied, t, last)
+
+        ray_hit = ~torch.isinf(first)
+        clipped_far = torch.min(far, last + step)
+        ray_travel_far[ray_idx] = torch.where(ray_hit, clipped_far, far)
+        ray_travel[ray_idx] = torch.where(ray_hit, torch.max(near, first - step), far)
+        hit[ray_idx] = ray_hit.squeeze(-1)
+        return ray_travel, ray_travel_far, hit
@@ -0,0 +1,39 @@
+import argparse
+import logging
+import os
+
+import yaml
+
+from edit3d.loaders.ShardLoaderN import pack_shards
+from edit3d.multimodal import get_data_lists
+from edit3d.utils.utils import dict2namespace
+
+logger = logging.getLogger(__name__)
+
+
+def main(args, cfg):
+    train_data_list, test_data_list = get_data_lists(cfg.data)
+    for split, data_list, imsize in (
+        ("train", train_data_list, cfg.data.train.imsize),
+        ("test", test_data_list, cfg.data.test.imsize),
+    ):
+        pack_shards(data_list, os.path.join(args.outdir, split), imsize=imsize, shard_bytes=args.shard_mb * 2 ** 20)
+    logger.info("Set data.shard_dir: %s in the config to train from the shards", args.outdir)
+
+
+if __name__ == "__main__":
+    # python -m edit3d.toolbox.pack_shards config/chair_train.yaml datasets/chairs/chairs_shards
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Pack the SDF samples, sketches and color images of the train and test splits of a config into "
+        "memory-mapped shards, read by data.shard_dir."
+    )
+    parser.add_argument("config", type=str, help="The configuration file.")
+    parser.add_argument("outdir", type=str, help="The dir to write the train and test shards to")
+    parser.add_argument("--shard_mb", default=1024, type=int, help="size of a shard file")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    cfg = dict2namespace(config)
+    main(args, cfg)
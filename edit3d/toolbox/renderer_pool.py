@@ -0,0 +1,57 @@
+import copy
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class RendererPool:
+    """LRU pool of SDF renderers keyed by their camera setup.
+
+    A renderer owns the camera rays, bounding-sphere intersections and background mask of one
+    (camera model, rotation, resolution, bsphere_r) setup. The pool hands back the same renderer for the same
+    setup and evicts the least recently used ones once their camera buffers exceed max_bytes.
+    """
+
+    def __init__(self, renderer_cls, device, max_bytes=256 * 1024 ** 2):
+        self.renderer_cls = renderer_cls
+        self.device = device
+        self.max_bytes = max_bytes
+        self.renderers = OrderedDict()
+        self.nbytes = 0
+
+    @staticmethod
+    def camera_key(cfg):
+        return (
+            cfg.cam_model.lower(),
+            float(cfg.rot_hor_deg),
+            float(cfg.rot_ver_deg),
+            tuple(cfg.resolution),
+            float(cfg.bsphere_r),
+            float(cfg.ver_scale),
+        )
+
+    # kwargs are forwarded to the renderer constructor, and set on the renderer when it is reused
+    def get(self, cfg, **kwargs):
+        key = self.camera_key(cfg)
+        renderer = self.renderers.get(key)
+        if renderer is not None:
+            self.renderers.move_to_end(key)
+            # shading settings (steps, colors, ...) are read at render time, keep them current
+            renderer.cfg = copy.copy(cfg)
+            for name, value in kwargs.items():
+                setattr(renderer, name, value)
+            return renderer
+
+        renderer = self.renderer_cls(copy.copy(cfg), self.device, **kwargs)
+        self.renderers[key] = renderer
+        self.nbytes += renderer.camera_nbytes()
+        while self.nbytes > self.max_bytes and len(self.renderers) > 1:
+            old_key, old_renderer = self.renderers.popitem(last=False)
+            self.nbytes -= old_renderer.camera_nbytes()
+            logger.debug("[RendererPool] evicted camera {}".format(old_key))
+        return renderer
+
+    def clear(self):
+        self.renderers.clear()
+        self.nbytes = 0
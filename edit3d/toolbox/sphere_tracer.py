@@ -0,0 +1,151 @@
+import torch
+import torch.nn.functional as F
+
+
+# sdf_fun / color_fun only get batch_idx when several latents are rendered together
+def eval_points(fun, p, batch_idx=None):
+    if batch_idx is None:
+        return fun(p)
+    return fun(p, batch_idx)
+
+
+# Sphere tracing over a flat wavefront, evaluating the decoder on the still-marching rays only.
+# A ray leaves the wavefront once it reaches the iso-surface (|step| <= converge_eps) or the far side of the
+# bounding sphere; its travel and last decoder outputs are scattered back into the full-size buffers.
+# The loop ends as soon as no ray is left, cfg.steps is only an upper bound.
+# cfg:
+# sdf_omega: 1.0 # over-relaxation, steps are omega * distance. A ray that overshoots (its unbounding spheres no
+#                # longer overlap) goes back to its last safe step and continues with omega = 1
+# refine_steps: 0 # regula falsi steps on the rays that did not leave the bounding sphere, to land on the iso-level
+# ray_ori, ray_dir: [R 3]
+# ray_travel, ray_travel_far: [R 1]
+# active: [R] bool, rays that enter the bounding sphere
+# keep: keys of the sdf_fun output to keep from the last evaluation of each ray, e.g. ("color3d",), "travel" keeps
+# the ray travel at that evaluation
+# batch_idx: [R] latent index of each ray, None when rendering a single latent
+# output: [R 1] ray travel, {key: [R C]} kept outputs (None if no ray was marched), number of steps used
+def march_active_rays(sdf_fun, ray_ori, ray_dir, ray_travel, ray_travel_far, active, cfg, keep=(), batch_idx=None):
+    ray_travel = ray_travel.clone()
+    kept = {key: None for key in keep}
+    converge_eps = getattr(cfg, "converge_eps", 1e-4)
+    omega = getattr(cfg, "sdf_omega", 1.0)
+    refine_steps = getattr(cfg, "refine_steps", 0)
+
+    # [T 1] signed distances at the rays ray_idx, keeping the requested outputs
+    def eval_rays(ray_idx, travel):
+        ray_batch_idx = None if batch_idx is None else batch_idx[ray_idx]
+        net_output = eval_points(sdf_fun, ray_ori[ray_idx] + travel * ray_dir[ray_idx], ray_batch_idx)
+        if "travel" in kept:
+            net_output = dict(net_output, travel=travel)
+        for key in keep:
+            value = net_output[key].reshape(ray_idx.size(0), -1)
+            if kept[key] is None:
+                kept[key] = torch.zeros(ray_travel.size(0), value.size(1), dtype=value.dtype, device=value.device)
+            kept[key][ray_idx] = value
+        return net_output["dists"].reshape(-1, 1) - cfg.sdf_iso_level
+
+    # per ray: relaxation factor, previous step for the overshoot fallback, last sample in front of the surface
+    ray_omega = torch.full_like(ray_travel, omega)
+    prev_travel = ray_travel.clone()
+    prev_dist = torch.zeros_like(ray_travel)
+    front_travel = ray_travel.clone()
+    front_dist = torch.full_like(ray_travel, float("nan"))
+
+    num_steps = 0
+    ray_idx = torch.nonzero(active, as_tuple=False).squeeze(-1)
+    for march_step in range(cfg.steps):
+        if ray_idx.numel() == 0:
+            break
+        print(".", end="", flush=True)
+        num_steps += 1
+        travel = ray_travel[ray_idx]
+        travel_far = ray_travel_far[ray_idx]
+        march_dist = eval_rays(ray_idx, travel)
+        front = march_dist > 0
+        front_travel[ray_idx] = torch.where(front, travel, front_travel[ray_idx])
+        front_dist[ray_idx] = torch.where(front, march_dist, front_dist[ray_idx])
+        march_dist = torch.clamp(march_dist, -cfg.sdf_clamp, cfg.sdf_clamp)
+
+        if omega > 1.0:
+            step_omega = ray_omega[ray_idx]
+            last_travel = prev_travel[ray_idx]
+            last_dist = prev_dist[ray_idx]
+            overshoot = (step_omega > 1.0) & (torch.abs(march_dist) + torch.abs(last_dist) < travel - last_travel)
+            ray_omega[ray_idx] = torch.where(overshoot, torch.ones_like(step_omega), step_omega)
+            prev_travel[ray_idx] = torch.where(overshoot, last_travel, travel)
+            prev_dist[ray_idx] = torch.where(overshoot, last_dist, march_dist)
+            travel = torch.where(
+                overshoot,
+                last_travel + last_dist * cfg.sdf_gain,
+                travel + march_dist * cfg.sdf_gain * step_omega,
+            )
+            # an overshooting ray has not converged, whatever its distance
+            march_dist = torch.where(overshoot, torch.full_like(march_dist, float("inf")), march_dist)
+        else:
+            travel = travel + march_dist * cfg.sdf_gain
+        travel = torch.min(travel, travel_far)
+        ray_travel[ray_idx] = travel
+
+        # drop rays that hit the surface or left the bounding sphere
+        marching = (torch.abs(march_dist) > converge_eps) & ((travel_far - travel) >= 1e-5)
+        ray_idx = ray_idx[marching.squeeze(-1)]
+
+    # Refinement of the surface hits: regula falsi once the surface is bracketed, a sphere step until then
+    ray_idx = torch.nonzero(active & ((ray_travel_far - ray_travel) >= 1e-5).squeeze(-1), as_tuple=False).squeeze(-1)
+    if ray_idx.numel() > 0 and refine_steps > 0:
+        back_travel = torch.full_like(ray_travel, float("nan"))
+        back_dist = torch.full_like(ray_travel, float("nan"))
+        for refine_step in range(refine_steps):
+            print(".", end="", flush=True)
+            num_steps += 1
+            travel = ray_travel[ray_idx]
+            march_dist = eval_rays(ray_idx, travel)
+            front = march_dist > 0
+            front_travel[ray_idx] = torch.where(front, travel, front_travel[ray_idx])
+            front_dist[ray_idx] = torch.where(front, march_dist, front_dist[ray_idx])
+            back_travel[ray_idx] = torch.where(front, back_travel[ray_idx], travel)
+            back_dist[ray_idx] = torch.where(front, back_dist[ray_idx], march_dist)
+            t0, d0 = front_travel[ray_idx], front_dist[ray_idx]
+            t1, d1 = back_travel[ray_idx], back_dist[ray_idx]
+            bracketed = ~torch.isnan(d0) & ~torch.isnan(d1)
+            secant = t0 + d0 * (t1 - t0) / (d0 - d1).clamp(min=1e-12)
+            sphere_step = travel + torch.clamp(march_dist, -cfg.sdf_clamp, cfg.sdf_clamp) * cfg.sdf_gain
+            travel = torch.where(bracketed, secant, sphere_step)
+            ray_travel[ray_idx] = torch.min(travel, ray_travel_far[ray_idx])
+    print("*")
+    return ray_travel, kept, num_steps
+
+
+# Surface normals at the points p, no graph is kept
+# mode:
+# autograd: gradient of the SDF w.r.t. p
+# tetrahedral: central differences on a tetrahedron, https://iquilezles.org/www/articles/normalsSDF/normalsSDF.htm
+# forward: forward differences along x, y, z; dists, the SDF at p, is reused from the march when given
+# The finite difference offsets of all the points go through one decoder call.
+# p: [M 3], batch_idx: [M] or None, dists: [M 1] or None
+# output: [M 3]
+def estimate_normals(sdf_fun, p, mode="autograd", batch_idx=None, dists=None, eps=5e-4):
+    if mode == "autograd":
+        with torch.enable_grad():
+            p = p.detach().requires_grad_(True)
+            d = eval_points(sdf_fun, p, batch_idx)["dists"]
+            grad = torch.autograd.grad(d, p, torch.ones_like(d))[0]
+        return F.normalize(grad, dim=-1)
+
+    if mode == "tetrahedral":
+        k = torch.tensor([[1, -1, -1], [-1, -1, 1], [-1, 1, -1], [1, 1, 1]], dtype=p.dtype, device=p.device)
+    elif mode == "forward":
+        k = torch.eye(3, dtype=p.dtype, device=p.device)
+        if dists is None:
+            k = torch.cat([k, torch.zeros_like(k[:1])], dim=0)
+    else:
+        raise NotImplementedError("Normal mode not recognised: {}".format(mode))
+    offsets = (p.unsqueeze(0) + eps * k.unsqueeze(1)).reshape(-1, 3)  # [K*M 3]
+    offsets_batch_idx = None if batch_idx is None else batch_idx.repeat(k.size(0))
+    d = eval_points(sdf_fun, offsets, offsets_batch_idx)["dists"].reshape(k.size(0), p.size(0), 1)
+    if mode == "tetrahedral":
+        grad = (k.unsqueeze(1) * d).sum(dim=0)
+    else:
+        center = d[3] if dists is None else dists.reshape(-1, 1)
+        grad = torch.cat([d[0], d[1], d[2]], dim=-1) - center
+    return F.normalize(grad, dim=-1)
@@ -0,0 +1,21 @@
+import os
+
+import imageio
+
+
+# num_views camera poses evenly spaced around the vertical axis, starting at rot_hor_deg
+# output: list of (rot_hor_deg, rot_ver_deg)
+def turntable_poses(num_views, rot_hor_deg=0.0, rot_ver_deg=0.0):
+    return [(rot_hor_deg + 360.0 * i / num_views, rot_ver_deg) for i in range(num_views)]
+
+
+# Write [H W 3] uint8 RGB frames, e.g. the [V H W 3] stack of SDFRenderer.render_views, to an .mp4 or .gif.
+# Frames are encoded one by one, so frames can also be a generator.
+def write_turntable(frames, filename, fps=12):
+    if os.path.splitext(filename)[1].lower() == ".gif":
+        writer = imageio.get_writer(filename, mode="I", duration=1000.0 / fps, loop=0)
+    else:
+        writer = imageio.get_writer(filename, fps=fps)
+    with writer:
+        for frame in frames:
+            writer.append_data(frame)
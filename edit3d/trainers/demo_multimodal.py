@@ -18,30 +18,6 @@ class Trainer(CrossModalTrainer):
     def set_clip_loss(self):
         self.clip_loss = CLIPLoss(image_size=128)
 
-    def _get_render_sdfs(self, zz_shape, zz_color):
-        def sdf_fun(p):  # p: N, 3
-            N = p.size(0)
-            p = p.unsqueeze(0)
-
-            z_shape = zz_shape
-            if len(z_shape.shape) == 2:
-                z_shape = z_shape.unsqueeze(1)
-            z_shape = z_shape.expand(-1, N, -1)
-            inp = torch.cat([z_shape, p], dim=-1)
-            dists, shape_feats = self.deepsdf_net(inp)  # [1 N 1]
-            dists = dists.reshape(-1, 1)
-
-            z_color = zz_color
-            if len(z_color.shape) == 2:
-                z_color = z_color.unsqueeze(1)
-            z_color = z_color.expand(-1, N, -1)
-            inp = torch.cat([z_color, shape_feats, p], dim=-1)
-            color3d = self.colorsdf_net(inp)  # [1 N 1]
-            color3d = color3d.reshape(-1, 3)
-            return {"dists": dists, "color3d": color3d}
-
-        return sdf_fun, None
-
     def get_known_latent(self, idx):
         num_known_shapes = len(self.sid2idx)
         if idx is None:
@@ -371,17 +347,83 @@ class Trainer(CrossModalTrainer):
             self.cfg.render_web.resolution = [resolution, resolution]
         latent_codes_fine_shape = feat_shape.to(self.device)
         latent_codes_fine_color = feat_color.to(self.device)
-        if not hasattr(self, "renderer"):
-            from toolbox.colorsdf_renderer import SDFRenderer
-
-            renderer = SDFRenderer(self.cfg.render_web, self.device, colorize)
+        renderer = self._get_renderer(colorize)
         self.eval()
         with torch.no_grad():
-            sdf_fun, _ = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            sdf_fun, color_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            occupancy = self._get_occupancy(latent_codes_fine_shape)
             print("R", end="")
-            img = renderer.render(sdf_fun, coloridx=None)
+            img = renderer.render(sdf_fun, coloridx=None, color_fun=color_fun, occupancy=occupancy)
         return img
 
+    # render a batch of 3D shapes in one pass, feat_shape/feat_color: [B D] -> [B H W 3] uint8
+    def render_express_batch(self, feat_shape, feat_color, resolution=512):
+        if resolution is not None:
+            self.cfg.render_web.resolution = [resolution, resolution]
+        latent_codes_fine_shape = feat_shape.to(self.device)
+        latent_codes_fine_color = feat_color.to(self.device)
+        renderer = self._get_renderer()
+        self.eval()
+        with torch.no_grad():
+            sdf_fun, color_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            occupancy = self._get_occupancy(latent_codes_fine_shape)
+            print("R", end="")
+            imgs = renderer.render_batch(
+                sdf_fun, feat_shape.size(0), coloridx=None, color_fun=color_fun, occupancy=occupancy
+            )
+        return imgs
+
+    # render the snapshots of an edit, each frame is warm started from the depth of the previous one
+    # feat_shapes: [T D] or list of [D] -> list of [H W 3] uint8
+    def render_express_sequence(self, feat_shapes, feat_color=None, resolution=512):
+        if feat_color == None:
+            colorize = False
+            _, feat_color = self.get_known_latent(0)
+        else:
+            colorize = True
+        if resolution is not None:
+            self.cfg.render_web.resolution = [resolution, resolution]
+        latent_codes_fine_color = feat_color.to(self.device)
+        renderer = self._get_renderer(colorize)
+        self.eval()
+        sdf_funs, color_funs, occupancies = [], [], []
+        with torch.no_grad():
+            for feat_shape in feat_shapes:
+                latent_codes_fine_shape = feat_shape.to(self.device)
+                sdf_fun, color_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+                sdf_funs.append(sdf_fun)
+                color_funs.append(color_fun)
+                occupancies.append(self._get_occupancy(latent_codes_fine_shape))
+            print("R", end="")
+            frames = renderer.render_sequence(sdf_funs, coloridx=None, color_funs=color_funs, occupancies=occupancies)
+            imgs = list(frames)
+        return imgs
+
+    # render 3D shapes from several camera poses, all views are traced in one pass
+    # poses: list of (rot_hor_deg, rot_ver_deg), defaults to num_views poses around the vertical axis
+    def render_turntable(self, feat_shape, feat_color=None, poses=None, num_views=12, resolution=512):
+        from toolbox.turntable import turntable_poses
+
+        if feat_color == None:
+            colorize = False
+            _, feat_color = self.get_known_latent(0)
+        else:
+            colorize = True
+        if resolution is not None:
+            self.cfg.render_web.resolution = [resolution, resolution]
+        if poses is None:
+            poses = turntable_poses(num_views, self.cfg.render_web.rot_hor_deg, self.cfg.render_web.rot_ver_deg)
+        latent_codes_fine_shape = feat_shape.to(self.device)
+        latent_codes_fine_color = feat_color.to(self.device)
+        renderer = self._get_renderer(colorize)
+        self.eval()
+        with torch.no_grad():
+            sdf_fun, color_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            occupancy = self._get_occupancy(latent_codes_fine_shape)
+            print("R", end="")
+            imgs = renderer.render_views(sdf_fun, poses, coloridx=None, color_fun=color_fun, occupancy=occupancy)
+        return imgs
+
     # render the sketch
     def render_sketch(self, feature):
         feature = feature.to(self.device)
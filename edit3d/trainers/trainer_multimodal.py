@@ -1,5 +1,6 @@
 import importlib
 import os
+from collections import OrderedDict
 
 # PyTorch
 import torch
@@ -411,10 +412,7 @@ class Trainer(BaseTrainer):
             rgb_samples = self._forward_colorgen(latent_codes_coarse_color, latent_codes_coarse_shape)
 
         # sample sdf with color info
-        rendered_imgs = []
-        for idx in range(latent_codes_coarse_shape.shape[0]):
-            rendered_img = self.render_express(latent_codes_coarse_shape[idx], latent_codes_coarse_color[idx])
-            rendered_imgs.append(rendered_img)
+        rendered_imgs = self.render_express_batch(latent_codes_coarse_shape, latent_codes_coarse_color)
 
         return {
             "gt_sketch": data_sketch,
@@ -424,53 +422,135 @@ class Trainer(BaseTrainer):
             "render_sdf": rendered_imgs,
         }
 
+    # zz_shape, zz_color: [D] or [B D] latents. With B > 1 the renderer passes batch_idx, the latent index
+    # of every query point, so all B shapes are decoded together.
+    # zz_color may be None when only the geometry (sdf_fun) is needed
     def _get_render_sdfs(self, zz_shape, zz_color):
-        def sdf_fun(p):  # p: N, 3
+        def expand_latent(z, N, batch_idx):
+            z = z.reshape(-1, z.size(-1))  # [B D]
+            if batch_idx is None:
+                return z.expand(N, -1)
+            return z[batch_idx]
+
+        # decoders that support it see the latents projected once per shape instead of once per point
+        shape_proj = None
+        if hasattr(self.deepsdf_net, "project_latent"):
+            shape_proj = self.deepsdf_net.project_latent(zz_shape.reshape(-1, zz_shape.size(-1)))
+        color_proj = None
+        if zz_color is not None and hasattr(self.colorsdf_net, "project_latent"):
+            color_proj = self.colorsdf_net.project_latent(zz_color.reshape(-1, zz_color.size(-1)))
+
+        def decode_shape(p, batch_idx):
             N = p.size(0)
-            p = p.unsqueeze(0)
-
-            z_shape = zz_shape
-            if len(z_shape.shape) == 1:
-                z_shape = z_shape.unsqueeze(0)
-            if len(z_shape.shape) == 2:
-                z_shape = z_shape.unsqueeze(1)
-            z_shape = z_shape.expand(-1, N, -1)
-            inp = torch.cat([z_shape, p], dim=-1)
-
-            dists, shape_feats = self.deepsdf_net(inp)  # [1 N 1]
+            if shape_proj is None:
+                inp = torch.cat([expand_latent(zz_shape, N, batch_idx), p], dim=-1)
+                return self.deepsdf_net(inp)
+            proj1, proj2 = [expand_latent(proj, N, batch_idx) for proj in shape_proj]
+            return self.deepsdf_net.forward_projected(proj1, proj2, p)
+
+        # geometry: only the shape decoder runs during ray marching
+        def sdf_fun(p, batch_idx=None):  # p: N, 3
+            dists, _ = decode_shape(p, batch_idx)  # [N 1]
             dists = dists.reshape(-1, 1)
+            return {"dists": dists}
 
-            z_color = zz_color
-            if len(z_color.shape) == 1:
-                z_color = z_color.unsqueeze(0)
-            if len(z_color.shape) == 2:
-                z_color = z_color.unsqueeze(1)
-            z_color = z_color.expand(-1, N, -1)
-            inp = torch.cat([z_color, shape_feats, p], dim=-1)
+        # appearance: evaluated once on the surface hit points
+        def color_fun(p, batch_idx=None):  # p: N, 3
+            N = p.size(0)
+            _, shape_feats = decode_shape(p, batch_idx)
             with torch.no_grad():
-                color3d = self.colorsdf_net(inp)  # [1 N 1]
+                if color_proj is None:
+                    inp = torch.cat([expand_latent(zz_color, N, batch_idx), shape_feats, p], dim=-1)
+                    color3d = self.colorsdf_net(inp)  # [N 3]
+                else:
+                    feat_p = torch.cat([shape_feats, p], dim=-1)
+                    color3d = self.colorsdf_net.forward_projected(expand_latent(color_proj, N, batch_idx), feat_p)
             color3d = color3d.reshape(-1, 3)
-            return {"dists": dists, "color3d": color3d}
+            return color3d
+
+        return sdf_fun, color_fun
 
-        return sdf_fun
+    # renderers are pooled per camera setup, so repeated renders reuse their camera rays
+    def _get_renderer(self, colorize=True):
+        if not hasattr(self, "renderer_pool"):
+            from toolbox.colorsdf_renderer import SDFRenderer
+            from toolbox.renderer_pool import RendererPool
+
+            max_bytes = getattr(self.cfg.render_web, "pool_mb", 256) * 1024 ** 2
+            self.renderer_pool = RendererPool(SDFRenderer, self.device, max_bytes=max_bytes)
+        return self.renderer_pool.get(self.cfg.render_web, colorize=colorize)
+
+    # Coarse occupancy grids for empty space skipping, one per shape latent, None if cfg.render_web.occupancy_res
+    # is not set. Grids are cached by latent, and by the decoder weights that the optimizer updates in place.
+    # zz_shape: [D] or [B D]
+    def _get_occupancy(self, zz_shape):
+        cfg = self.cfg.render_web
+        resolution = getattr(cfg, "occupancy_res", None)
+        if not resolution:
+            return None
+        from toolbox.occupancy_grid import OccupancyGrid
+
+        if not hasattr(self, "occupancy_cache"):
+            self.occupancy_cache = OrderedDict()
+        weights_version = sum(param._version for param in self.deepsdf_net.parameters())
+        latents = zz_shape.detach().reshape(-1, zz_shape.size(-1))
+        keys = [
+            (z.cpu().numpy().tobytes(), weights_version, float(cfg.bsphere_r), resolution, float(cfg.sdf_iso_level))
+            for z in latents
+        ]
+        missing = [i for i, key in enumerate(keys) if key not in self.occupancy_cache]
+        if len(missing) > 0:
+            sdf_fun, _ = self._get_render_sdfs(latents[missing], None)
+            with torch.no_grad():
+                grid = OccupancyGrid.from_sdf(
+                    sdf_fun,
+                    cfg.bsphere_r,
+                    resolution=resolution,
+                    iso_level=cfg.sdf_iso_level,
+                    num_latents=len(missing),
+                    device=self.device,
+                )
+            for j, i in enumerate(missing):
+                self.occupancy_cache[keys[i]] = OccupancyGrid(grid.occupied[j : j + 1], grid.bound)
+        grids = []
+        for key in keys:
+            self.occupancy_cache.move_to_end(key)
+            grids.append(self.occupancy_cache[key])
+        while len(self.occupancy_cache) > getattr(cfg, "occupancy_cache", 64):
+            self.occupancy_cache.popitem(last=False)
+        return OccupancyGrid.cat(grids)
 
     def render_express(self, feat_shape, feat_color):
 
         latent_codes_fine_shape = feat_shape.to(self.device)
         latent_codes_fine_color = feat_color.to(self.device)
-        if not hasattr(self, "renderer"):
-            from toolbox.colorsdf_renderer import SDFRenderer
-
-            renderer = SDFRenderer(self.cfg.render_web, self.device)
+        renderer = self._get_renderer()
         self.eval()
         with torch.no_grad():
-            sdf_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            sdf_fun, color_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            occupancy = self._get_occupancy(latent_codes_fine_shape)
             print("R", end="")
-            img = renderer.render(sdf_fun, coloridx=None)
+            img = renderer.render(sdf_fun, coloridx=None, color_fun=color_fun, occupancy=occupancy)
             # img = img[...,[2,1,0]] # RGB -> BGR
         self.train()
         return img
 
+    # render a batch of 3D shapes in one pass, feat_shape/feat_color: [B D] -> [B H W 3] uint8
+    def render_express_batch(self, feat_shape, feat_color):
+        latent_codes_fine_shape = feat_shape.to(self.device)
+        latent_codes_fine_color = feat_color.to(self.device)
+        renderer = self._get_renderer()
+        self.eval()
+        with torch.no_grad():
+            sdf_fun, color_fun = self._get_render_sdfs(latent_codes_fine_shape, latent_codes_fine_color)
+            occupancy = self._get_occupancy(latent_codes_fine_shape)
+            print("R", end="")
+            imgs = renderer.render_batch(
+                sdf_fun, feat_shape.size(0), coloridx=None, color_fun=color_fun, occupancy=occupancy
+            )
+        self.train()
+        return imgs
+
     # save checkpoints
     def save(self, epoch, step):
         save_name = f"epoch_{epoch}_iters_{step}.pth"
@@ -0,0 +1,79 @@
+import uuid
+import weakref
+
+import torch
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StagingRing:
+    """
+    num_slots batches of preallocated shared memory tensors, that DataLoader workers collate batches into and that the
+    main process hands to the trainer, pinned, without copying them, see NPYLoaderN.__getitems__
+
+    shapes: {key: (shape of a full batch, dtype)}. Slot n % num_slots is reused for batch n, see SlotBatchSampler, so
+    num_slots must exceed the batches in flight, num_workers * prefetch_factor, plus the batches the trainer holds,
+    including the one whose non_blocking copies may still be running.
+    """
+
+    # the rings created in this process, by id, for StagedBatch.pin_memory
+    rings = weakref.WeakValueDictionary()
+
+    def __init__(self, num_slots, shapes, pin=None):
+        self.id = uuid.uuid4().hex
+        self.num_slots = num_slots
+        self.slots = [
+            {key: torch.zeros(shape, dtype=dtype).share_memory_() for key, (shape, dtype) in shapes.items()}
+            for _ in range(num_slots)
+        ]
+        self.pin = torch.cuda.is_available() if pin is None else pin
+        self.pinned = False
+        StagingRing.rings[self.id] = self
+        logger.info(
+            "[StagingRing] %d slots of %.1f MB",
+            num_slots,
+            sum(t.numel() * t.element_size() for t in self.slots[0].values()) / 2 ** 20,
+        )
+
+    def __getstate__(self):
+        # workers only write the slots
+        state = self.__dict__.copy()
+        state["pinned"] = False
+        return state
+
+    def slot(self, slot, size):
+        """The tensors of a slot, for a batch of size"""
+        return {key: tensor[:size] for key, tensor in self.slots[slot].items()}
+
+    def pin_memory(self):
+        """Page-lock the slots in this process once, so that copies from them to the GPU are asynchronous"""
+        if self.pinned or not self.pin:
+            return
+        cudart = torch.cuda.cudart()
+        for tensors in self.slots:
+            for tensor in tensors.values():
+                # cudaHostRegisterDefault
+                error = cudart.cudaHostRegister(tensor.data_ptr(), tensor.numel() * tensor.element_size(), 0)
+                if error != 0:
+                    raise RuntimeError("cudaHostRegister failed: %s" % error)
+        self.pinned = True
+
+
+class StagedBatch:
+    """A batch written into slot of the StagingRing ring_id, sent from a worker in place of its tensors"""
+
+    def __init__(self, ring_id, slot, size, data):
+        self.ring_id = ring_id
+        self.slot = slot
+        self.size = size
+        self.data = data
+
+    def pin_memory(self):
+        """The batch as views of the slot of the ring of the main process, as PinMemDict.pin_memory"""
+        ring = StagingRing.rings[self.ring_id]
+        ring.pin_memory()
+        out_b = ring.slot(self.slot, self.size)
+        out_b.update(self.data)
+        return out_b